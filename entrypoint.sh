@@ -29,14 +29,13 @@ export PGPASSWORD=$POSTGRES_PASSWORD
 echo -e "${GREEN}\n\n1. Top 5 samples by library size:${NC}"
 # 
 psql -h "$DB_HOST" -U "$USER" -d "$DB_NAME" -c "
-SELECT (SELECT COUNT(*) FROM runs) as total_runs, (SELECT COUNT(*) FROM samples) as total_samples;"
+SELECT total_runs, total_samples FROM kpi_overview;"
 
 
 echo -e "${GREEN}\n\n 2. Average library size by condition: ${NC}"
 
 psql -h "$DB_HOST" -U "$USER" -d "$DB_NAME" -c " 
-SELECT condition, COUNT(*), ROUND(AVG(library_size)::numeric, 0) as avg_lib FROM samples s 
-JOIN qc_metrics q ON s.sample_id = q.sample_id GROUP BY condition;"
+SELECT condition, n_samples, ROUND(avg_lib_size, 0) as avg_lib FROM kpi_condition_library_size;"
 
 echo -e "\n\n"
 
@@ -3,32 +3,20 @@
 
 echo -e "\n--- DASHBOARD AUTOMATIQUE (KPIs) ---"
 
-# Exécution des KPIs via psql
-docker exec -t rnaseq_db psql -U rnaseq_user -d rnaseq_db -c "
+# Les KPIs sont lus depuis des vues sur les tables de résumé par run, mises à jour
+# à chaque export (voir sql/create_tables.sql) : aucune requête ne réagrège qc_metrics.
+
 echo '--- RÉSUMÉ GLOBAL ---'
-SELECT 
-    (SELECT COUNT(*) FROM runs) as total_runs,
-    (SELECT COUNT(*) FROM samples) as total_samples,
-    (SELECT COUNT(*) FROM qc_metrics) as total_qc_records;
+docker exec -t rnaseq_db psql -U rnaseq_user -d rnaseq_db -c "
+SELECT total_runs, total_samples, total_qc_records FROM kpi_overview;"
 
 echo '--- ANALYSE PAR CONDITION BIOLOGIQUE ---'
-SELECT 
-    condition, 
-    COUNT(*) as n_samples,
-    ROUND(AVG(qc.library_size)::numeric, 2) as avg_lib_size
-FROM samples s
-JOIN qc_metrics qc ON s.sample_id = qc.sample_id
-GROUP BY condition;
+docker exec -t rnaseq_db psql -U rnaseq_user -d rnaseq_db -c "
+SELECT condition, n_samples, avg_lib_size, sd_lib_size, min_lib_size, max_lib_size
+FROM kpi_condition_library_size;"
 
 echo '--- DERNIER RUN EXÉCUTÉ ---'
-SELECT 
-    run_id, 
-    run_name, 
-    pipeline_version, 
-    created_at 
-FROM runs 
-ORDER BY created_at DESC 
-LIMIT 1;
-"
+docker exec -t rnaseq_db psql -U rnaseq_user -d rnaseq_db -c "
+SELECT run_id, run_name, pipeline_version, created_at, n_samples FROM kpi_latest_run;"
 
-echo -e "${GREEN}Dashboard généré avec succès à $(date)${NC}"
\ No newline at end of file
+echo -e "${GREEN}Dashboard généré avec succès à $(date)${NC}"
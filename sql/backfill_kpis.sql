@@ -0,0 +1,35 @@
+-- One-off upgrade of a database created before the KPI summary tables existed.
+-- Run once with: python -m rnaseq.db_setup --upgrade
+-- (create_tables.sql has already been applied, see db_setup.upgrade_database)
+-- Every statement only touches rows that are still missing, so rerunning it is harmless.
+
+-- Runs completed before completed_at existed
+UPDATE runs SET completed_at = created_at WHERE status = 'completed' AND completed_at IS NULL;
+
+-- Per-run summary of the runs exported before kpi_run_summary existed
+INSERT INTO kpi_run_summary (run_id, run_name, pipeline_version, dataset_id, created_at, n_samples,
+                             total_library_size, avg_library_size, min_library_size, max_library_size,
+                             avg_zero_fraction, avg_expressed_genes)
+SELECT r.run_id, r.run_name, r.pipeline_version, r.dataset_id, r.created_at, COUNT(q.sample_id),
+       SUM(q.library_size), ROUND(AVG(q.library_size), 2), MIN(q.library_size), MAX(q.library_size),
+       ROUND(AVG(q.zero_fraction), 3), ROUND(AVG(q.expressed_genes), 2)
+FROM runs r
+LEFT JOIN qc_metrics q ON q.run_id = r.run_id
+WHERE r.status = 'completed'
+  AND NOT EXISTS (SELECT 1 FROM kpi_run_summary k WHERE k.run_id = r.run_id)
+GROUP BY r.run_id
+ON CONFLICT (run_id) DO NOTHING;
+
+-- Per-(run, condition) sums of the completed runs exported before kpi_run_condition_summary existed
+INSERT INTO kpi_run_condition_summary (run_id, condition, n_samples, sum_library_size, sum_sq_library_size,
+                                       min_library_size, max_library_size)
+SELECT q.run_id, COALESCE(s.condition, 'unknown'), COUNT(*),
+       SUM(q.library_size), SUM(q.library_size::NUMERIC * q.library_size),
+       MIN(q.library_size), MAX(q.library_size)
+FROM qc_metrics q
+JOIN samples s ON s.sample_id = q.sample_id
+JOIN runs r ON r.run_id = q.run_id
+WHERE r.status = 'completed'
+  AND NOT EXISTS (SELECT 1 FROM kpi_run_condition_summary k WHERE k.run_id = q.run_id)
+GROUP BY q.run_id, COALESCE(s.condition, 'unknown')
+ON CONFLICT (run_id, condition) DO NOTHING;
@@ -12,6 +12,19 @@ CREATE TABLE IF NOT EXISTS runs (
     dataset_id VARCHAR(50)
 );
 
+-- Input fingerprint (sha256 of counts file, samples file, config and version)
+-- and export status: 'running' until the data transaction commits, then 'completed'.
+-- created_at is the creation time of the run, completed_at is updated on every
+-- committed export into it (replace, --append)
+ALTER TABLE runs ADD COLUMN IF NOT EXISTS counts_sha256 CHAR(64);
+ALTER TABLE runs ADD COLUMN IF NOT EXISTS samples_sha256 CHAR(64);
+ALTER TABLE runs ADD COLUMN IF NOT EXISTS config_sha256 CHAR(64);
+ALTER TABLE runs ADD COLUMN IF NOT EXISTS input_fingerprint CHAR(64);
+ALTER TABLE runs ADD COLUMN IF NOT EXISTS status VARCHAR(20) NOT NULL DEFAULT 'completed';
+ALTER TABLE runs ADD COLUMN IF NOT EXISTS completed_at TIMESTAMP;
+
+CREATE UNIQUE INDEX IF NOT EXISTS runs_input_fingerprint_key ON runs (input_fingerprint);
+
 CREATE TABLE IF NOT EXISTS qc_metrics (
     run_id INTEGER REFERENCES runs(run_id),
     sample_id VARCHAR REFERENCES samples(sample_id),
@@ -21,4 +34,71 @@ CREATE TABLE IF NOT EXISTS qc_metrics (
     PRIMARY KEY (run_id, sample_id),
     FOREIGN KEY (run_id) REFERENCES runs(run_id) ON DELETE CASCADE,
     FOREIGN KEY (sample_id) REFERENCES samples(sample_id) ON DELETE CASCADE
-);
\ No newline at end of file
+);
+
+-- Dashboard KPIs ------------------------------------------------------------
+-- Supporting indexes for the latest-run lookups and the metrics joins
+CREATE INDEX IF NOT EXISTS runs_created_at_idx ON runs (created_at DESC);
+CREATE INDEX IF NOT EXISTS runs_dataset_created_at_idx ON runs (dataset_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS qc_metrics_sample_id_idx ON qc_metrics (sample_id);
+
+-- Per-run summary, maintained incrementally: the export upserts the row of its
+-- own run in the same transaction as the run's metrics
+CREATE TABLE IF NOT EXISTS kpi_run_summary (
+    run_id INTEGER PRIMARY KEY REFERENCES runs(run_id) ON DELETE CASCADE,
+    run_name VARCHAR(50),
+    pipeline_version VARCHAR(50),
+    dataset_id VARCHAR(50),
+    created_at TIMESTAMP,
+    n_samples INTEGER NOT NULL,
+    total_library_size BIGINT,
+    avg_library_size NUMERIC(14,2),
+    min_library_size BIGINT,
+    max_library_size BIGINT,
+    avg_zero_fraction NUMERIC(6,3),
+    avg_expressed_genes NUMERIC(10,2)
+);
+
+CREATE INDEX IF NOT EXISTS kpi_run_summary_created_at_idx ON kpi_run_summary (created_at DESC);
+
+-- Latest completed run: a single index scan on kpi_run_summary_created_at_idx
+CREATE OR REPLACE VIEW kpi_latest_run AS
+SELECT run_id, run_name, pipeline_version, dataset_id, created_at, n_samples
+FROM kpi_run_summary
+ORDER BY created_at DESC
+LIMIT 1;
+
+-- Per-(run, condition) library size sums, maintained like kpi_run_summary: the
+-- export recomputes the rows of its own run only, in the run's transaction.
+-- Only completed runs have rows, and the sums (exact NUMERIC) combine across runs
+CREATE TABLE IF NOT EXISTS kpi_run_condition_summary (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+    condition VARCHAR(50) NOT NULL,
+    n_samples INTEGER NOT NULL,
+    sum_library_size NUMERIC NOT NULL,
+    sum_sq_library_size NUMERIC NOT NULL,
+    min_library_size BIGINT,
+    max_library_size BIGINT,
+    PRIMARY KEY (run_id, condition)
+);
+
+-- Library size statistics per biological condition over completed runs, combined
+-- from the per-run sums (the standard deviation from the sums of squares)
+CREATE OR REPLACE VIEW kpi_condition_library_size AS
+SELECT condition,
+       SUM(n_samples) AS n_samples,
+       ROUND(SUM(sum_library_size) / SUM(n_samples), 2) AS avg_lib_size,
+       ROUND(SQRT(GREATEST(SUM(sum_sq_library_size) - SUM(sum_library_size) ^ 2 / SUM(n_samples), 0)
+                  / NULLIF(SUM(n_samples) - 1, 0)), 2) AS sd_lib_size,
+       MIN(min_library_size) AS min_lib_size,
+       MAX(max_library_size) AS max_lib_size
+FROM kpi_run_condition_summary
+GROUP BY condition;
+
+-- Global counters, one row. Runs and QC records come from the per-run summary,
+-- samples from the primary key of the samples table (one row per distinct sample)
+CREATE OR REPLACE VIEW kpi_overview AS
+SELECT 1 AS id,
+       (SELECT COUNT(*) FROM kpi_run_summary) AS total_runs,
+       (SELECT COUNT(*) FROM samples) AS total_samples,
+       (SELECT COALESCE(SUM(n_samples), 0) FROM kpi_run_summary) AS total_qc_records;
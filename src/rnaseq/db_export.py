@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+"""Background PostgreSQL export.
+
+The pipeline stages hand their DataFrames to a BackgroundExporter, which
+writes them from a dedicated thread while the remaining stages (plots)
+keep running. A bounded queue gives back-pressure, transient connection
+errors are retried with exponential backoff, and close() flushes the
+queue and joins the writer before the pipeline exits.
+
+Runs are identified by an input fingerprint (hashes of the counts file,
+samples file, config and pipeline version). When a completed run with the
+same fingerprint exists, the export is skipped or that run is replaced.
+All data of a run is written in a single transaction, committed together
+with status = 'completed', so a failed export never leaves partial metrics.
+"""
+
+import hashlib
+import os
+import queue
+import threading
+import time
+
+import psycopg2
+
+from rnaseq.db_setup import (
+    connect_database,
+    create_tables,
+    register_run,
+    latest_run_id,
+    find_run_by_fingerprint,
+    set_run_status,
+    refresh_run_summary,
+    refresh_condition_summary,
+    insert_dataframe,
+)
+
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+ON_DUPLICATE = {"skip", "replace"}
+
+_STOP = object() # queue sentinel
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    sha256 hex digest of a file, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def input_fingerprint(counts_path: str, samples_path: str, config_path: str, version: str) -> dict:
+    """
+    Hashes identifying the inputs of a run.
+
+    Returns
+    -------
+    dict
+        counts_sha256, samples_sha256, config_sha256 and input_fingerprint,
+        the latter combining the three file hashes with the pipeline version.
+    """
+    fingerprint = {
+        "counts_sha256": file_sha256(counts_path),
+        "samples_sha256": file_sha256(samples_path),
+        "config_sha256": file_sha256(config_path),
+    }
+    combined = "\n".join([fingerprint["counts_sha256"], fingerprint["samples_sha256"],
+                          fingerprint["config_sha256"], str(version)])
+    fingerprint["input_fingerprint"] = hashlib.sha256(combined.encode()).hexdigest()
+    return fingerprint
+
+
+class BackgroundExporter:
+    """
+    Thread-backed writer for the runs, samples and qc_metrics tables.
+
+    Parameters
+    ----------
+    dataset_id, version, run_name : str
+        Run metadata; default to the DATASET_ID / PIPELINE_VERSION environment variables.
+    max_pending : int
+        Maximum number of queued tables before submit() blocks.
+    max_retries : int
+        Attempts per write on transient connection errors.
+    backoff : float
+        Initial retry delay in seconds, doubled after each failed attempt.
+    connect : callable
+        Connection factory, connect_database by default.
+    append : bool
+        Attach the writes to the latest run of the dataset (a new run is only
+        registered when none exists) and upsert qc_metrics rows.
+    input_files : dict, optional
+        Paths of the 'counts', 'samples' and 'config' files. Their hashes are
+        computed in the writer thread and used to deduplicate runs.
+    on_duplicate : str
+        What to do when a completed run has the same fingerprint:
+        'skip' the export or 'replace' that run's data.
+    """
+
+    def __init__(self, dataset_id=None, version=None, run_name=None, max_pending=4,
+                 max_retries=5, backoff=0.5, connect=connect_database, append=False,
+                 input_files=None, on_duplicate="skip"):
+        if on_duplicate not in ON_DUPLICATE:
+            raise ValueError(f"on_duplicate must be one of {sorted(ON_DUPLICATE)}, got {on_duplicate!r}")
+
+        self.dataset_id = dataset_id or os.getenv("DATASET_ID", "Unknown_Dataset")
+        self.version = version or os.getenv("PIPELINE_VERSION", "Unknown_Version")
+        self.run_name = run_name or f"Run_{self.dataset_id}"
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.connect = connect
+        self.append = append
+        self.input_files = input_files
+        self.on_duplicate = on_duplicate
+
+        self.fingerprint = None
+        self.run_id = None
+        self.skipped = False
+        self.error = None
+        self._keep_status = False # run_id is a completed run written into (replace or append)
+        self._journal = [] # tables written in the open transaction, replayed after a reconnect
+        self._conn = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._worker, name="db-export", daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(commit=exc_type is None)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def submit(self, table_name: str, df) -> None:
+        """
+        Queue a DataFrame for insertion into table_name.
+        Blocks while max_pending tables are already waiting.
+        """
+        if not self._thread.is_alive():
+            raise RuntimeError("BackgroundExporter is not running")
+        self._queue.put((table_name, df.copy()))
+
+    def submit_qc_table(self, qc_df) -> None:
+        """
+        Queue a per-sample QC table for both the samples and qc_metrics tables.
+        """
+        if qc_df.index.name == "sample_id":
+            qc_df = qc_df.reset_index()
+        self.submit("samples", qc_df)
+        self.submit("qc_metrics", qc_df)
+
+    def close(self, commit: bool = True) -> None:
+        """
+        Flush pending writes, stop the writer thread and report any failure.
+
+        With commit=True the run's transaction is committed and the run marked
+        'completed'; otherwise it is rolled back and the run marked 'failed'.
+        """
+        if self._thread.is_alive():
+            self._queue.put((_STOP, commit))
+            self._thread.join()
+        if self.error is not None:
+            raise RuntimeError(f"Database export failed: {self.error}") from self.error
+
+    def _worker(self) -> None:
+        try:
+            while True:
+                item = self._queue.get()
+                if item[0] is _STOP:
+                    self._finish(commit=item[1])
+                    break
+                if self.error is None and not self.skipped: # keep draining so producers never block
+                    try:
+                        self._with_retry(self._write, *item)
+                    except Exception as e:
+                        self.error = e
+                        print(f"Error during insertion into {item[0]}: {e}")
+        finally:
+            if self._conn is not None:
+                self._conn.close()
+
+    def _with_retry(self, func, *args):
+        delay = self.backoff
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                if self._conn is None or self._conn.closed:
+                    self._conn = self.connect()
+                    if self.run_id is None:
+                        create_tables(self._conn)
+                    else:
+                        self._replay()
+                return func(*args)
+            except TRANSIENT_ERRORS as e:
+                if self._conn is not None:
+                    self._conn.close()
+                self._conn = None
+                if attempt == self.max_retries:
+                    raise
+                print(f"Transient database error ({e}); retrying in {delay:.1f}s [{attempt}/{self.max_retries}]")
+                time.sleep(delay)
+                delay *= 2
+
+    def _begin_run(self) -> None:
+        """
+        Resolve the run to write into; commits only the run bookkeeping.
+        """
+        if self.input_files and self.fingerprint is None:
+            self.fingerprint = input_fingerprint(self.input_files["counts"], self.input_files["samples"],
+                                                 self.input_files["config"], self.version)
+
+        with self._conn.cursor() as cur:
+            existing = find_run_by_fingerprint(cur, self.fingerprint["input_fingerprint"]) if self.fingerprint else None
+            run_id = latest_run_id(cur, self.dataset_id) if self.append and existing is None else None
+
+            if existing and existing[1] == "completed":
+                if self.on_duplicate == "skip":
+                    self._conn.rollback()
+                    self.skipped = True
+                    print(f"Identical inputs already exported as run {existing[0]}; skipping database export.")
+                    return
+                run_id, self._keep_status = existing[0], True # status only changes when the new data commits
+            elif existing:
+                run_id = existing[0] # leftover of an interrupted export: reuse it
+                set_run_status(cur, run_id, "running")
+            elif run_id is None:
+                run_id = register_run(cur, self.run_name, self.version, self.dataset_id,
+                                      fingerprint=self.fingerprint, status="running")
+            else:
+                self._keep_status = True # appending to the latest completed run
+        self._conn.commit()
+        self.run_id = run_id
+
+    def _clear_run(self, cur) -> None:
+        # a replaced or reused run starts from an empty set of metrics
+        if not self.append:
+            cur.execute("DELETE FROM qc_metrics WHERE run_id = %s", (self.run_id,))
+
+    def _replay(self) -> None:
+        """Re-execute the open transaction after a reconnect."""
+        with self._conn.cursor() as cur:
+            self._clear_run(cur)
+            for table_name, df in self._journal:
+                insert_dataframe(cur, df, table_name, self.run_id, upsert=self.append)
+
+    def _write(self, table_name, df) -> None:
+        if self.run_id is None:
+            self._begin_run()
+            if self.skipped:
+                return
+            with self._conn.cursor() as cur:
+                self._clear_run(cur)
+
+        with self._conn.cursor() as cur:
+            n_rows = insert_dataframe(cur, df, table_name, self.run_id, upsert=self.append)
+        self._journal.append((table_name, df))
+        if n_rows:
+            print(f"Inserted {n_rows} rows into {table_name} (pending commit)")
+
+    def _commit_run(self) -> None:
+        with self._conn.cursor() as cur:
+            set_run_status(cur, self.run_id, "completed", fingerprint=self.fingerprint, version=self.version)
+            refresh_run_summary(cur, self.run_id)
+            refresh_condition_summary(cur, self.run_id)
+        self._conn.commit()
+        self._journal = []
+        print(f"Run {self.run_id} exported successfully.")
+
+    def _finish(self, commit: bool) -> None:
+        if self.skipped or self.run_id is None:
+            return
+
+        if commit and self.error is None:
+            try:
+                self._with_retry(self._commit_run)
+                return
+            except Exception as e:
+                self.error = e
+                print(f"Error while committing run {self.run_id}: {e}")
+
+        # roll back the data; a completed run that was replaced or appended to keeps
+        # its previous data and status, only runs this export started are marked failed
+        try:
+            if self._conn is None or self._conn.closed:
+                self._conn = self.connect()
+            else:
+                self._conn.rollback()
+            if not self._keep_status:
+                with self._conn.cursor() as cur:
+                    set_run_status(cur, self.run_id, "failed")
+                self._conn.commit()
+        except Exception as e:
+            print(f"Could not mark run {self.run_id} as failed: {e}")
@@ -1,5 +1,7 @@
+import argparse
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 import os , sys
 import yaml
 from dotenv import load_dotenv
@@ -7,6 +9,9 @@ import pandas as pd
 
 load_dotenv()  # Load environment variables from .env file
 
+CONFLICT_KEYS = {"qc_metrics": ("run_id", "sample_id")} # primary keys used for upserts
+LEGACY_KPI_VIEWS = ("kpi_condition_library_size", "kpi_overview") # materialized views replaced by plain views
+
 def connect_database() -> None:
     """
     Set up the PostgreSQL database.
@@ -20,12 +25,13 @@ def connect_database() -> None:
         port = os.getenv("POSTGRES_PORT")
     )
 
-def create_tables(conn) -> None:
-    """ Create necessary tables in the database.
+def execute_sql_file(conn, path) -> None:
+    """
+    Execute the ';'-separated statements of an SQL file and commit.
     """
     cur = conn.cursor()
 
-    with open ("./sql/create_tables.sql", 'r') as f:
+    with open (path, 'r') as f:
         sql_content = f.read()
 
         commands = sql_content.split(';')
@@ -36,67 +42,214 @@ def create_tables(conn) -> None:
                 cur.execute(command)
     conn.commit() # python works with transactions , have to commit changes 
     cur.close()
+
+def create_tables(conn) -> None:
+    """ Create necessary tables in the database.
+    """
+    execute_sql_file(conn, "./sql/create_tables.sql")
     print('Tables created successfully.')
 
-def insert_postgresql_db(con, csv_path, table_name, dataset_id, version, run_name) -> None:
-    df = pd.read_csv(csv_path)
-    
+def upgrade_database(conn) -> None:
+    """
+    One-off upgrade of a database created by an earlier version of the pipeline.
+
+    The KPI materialized views are dropped (they are plain views over the
+    summary tables now), the schema is created, and the summary tables
+    and completed_at are backfilled from the existing runs with
+    sql/backfill_kpis.sql. Exports never run this: the backfills scan
+    all the metrics.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT matviewname FROM pg_matviews WHERE matviewname = ANY(%s)", (list(LEGACY_KPI_VIEWS),))
+        for (view,) in cur.fetchall():
+            cur.execute(f"DROP MATERIALIZED VIEW {view}")
+    conn.commit()
+    create_tables(conn)
+    execute_sql_file(conn, "./sql/backfill_kpis.sql")
+    print('Database upgraded successfully.')
+
+def register_run(cur, run_name, version, dataset_id, fingerprint=None, status="completed") -> int:
+    """
+    Insert a row in 'runs' and return its run_id.
+    fingerprint is the dict returned by db_export.input_fingerprint, if any.
+    """
     # Safety: Ensure these are never None
     dataset_id = dataset_id or "Unknown_DS"
     version = version or "Unknown_version"
     run_name = run_name or f"Run_{dataset_id}"
+    fingerprint = fingerprint or {}
+
+    run_query = """
+        INSERT INTO runs (run_name, pipeline_version, dataset_id, status, completed_at,
+                          counts_sha256, samples_sha256, config_sha256, input_fingerprint) 
+        VALUES (%s, %s, %s, %s, CASE WHEN %s = 'completed' THEN CURRENT_TIMESTAMP END,
+                %s, %s, %s, %s) RETURNING run_id
+    """
+    cur.execute(run_query, (run_name, version, dataset_id, status, status,
+                            fingerprint.get("counts_sha256"), fingerprint.get("samples_sha256"),
+                            fingerprint.get("config_sha256"), fingerprint.get("input_fingerprint")))
+    return cur.fetchone()[0]
+
+def find_run_by_fingerprint(cur, input_fingerprint):
+    """
+    Return (run_id, status) of the run with this input fingerprint, or None.
+    The row is locked until the end of the transaction.
+    """
+    cur.execute(
+        "SELECT run_id, status FROM runs WHERE input_fingerprint = %s FOR UPDATE",
+        (input_fingerprint,),
+    )
+    return cur.fetchone()
+
+def set_run_status(cur, run_id, status, fingerprint=None, version=None) -> None:
+    """
+    Update the status of a run; the fingerprint and version are refreshed when given.
+    completed_at is set when the run becomes 'completed'.
+    """
+    fingerprint = fingerprint or {}
+    cur.execute(
+        """
+        UPDATE runs SET status = %s,
+            completed_at = CASE WHEN %s = 'completed' THEN CURRENT_TIMESTAMP ELSE completed_at END,
+            counts_sha256 = COALESCE(%s, counts_sha256),
+            samples_sha256 = COALESCE(%s, samples_sha256),
+            config_sha256 = COALESCE(%s, config_sha256),
+            input_fingerprint = COALESCE(%s, input_fingerprint),
+            pipeline_version = COALESCE(%s, pipeline_version)
+        WHERE run_id = %s
+        """,
+        (status, status, fingerprint.get("counts_sha256"), fingerprint.get("samples_sha256"),
+         fingerprint.get("config_sha256"), fingerprint.get("input_fingerprint"), version, run_id),
+    )
+
+def latest_run_id(cur, dataset_id):
+    """
+    Return the run_id of the most recent completed run of dataset_id, or None.
+    Running or failed runs are ignored: their metrics are partial or absent.
+    """
+    cur.execute(
+        "SELECT run_id FROM runs WHERE dataset_id = %s AND status = 'completed' ORDER BY created_at DESC LIMIT 1",
+        (dataset_id,),
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def refresh_run_summary(cur, run_id) -> None:
+    """
+    Recompute the kpi_run_summary row of a single run from its metrics.
+    """
+    cur.execute(
+        """
+        INSERT INTO kpi_run_summary (run_id, run_name, pipeline_version, dataset_id, created_at, n_samples,
+                                     total_library_size, avg_library_size, min_library_size, max_library_size,
+                                     avg_zero_fraction, avg_expressed_genes)
+        SELECT r.run_id, r.run_name, r.pipeline_version, r.dataset_id, r.created_at, COUNT(q.sample_id),
+               SUM(q.library_size), ROUND(AVG(q.library_size), 2), MIN(q.library_size), MAX(q.library_size),
+               ROUND(AVG(q.zero_fraction), 3), ROUND(AVG(q.expressed_genes), 2)
+        FROM runs r
+        LEFT JOIN qc_metrics q ON q.run_id = r.run_id
+        WHERE r.run_id = %s
+        GROUP BY r.run_id
+        ON CONFLICT (run_id) DO UPDATE SET
+            run_name = EXCLUDED.run_name,
+            pipeline_version = EXCLUDED.pipeline_version,
+            dataset_id = EXCLUDED.dataset_id,
+            created_at = EXCLUDED.created_at,
+            n_samples = EXCLUDED.n_samples,
+            total_library_size = EXCLUDED.total_library_size,
+            avg_library_size = EXCLUDED.avg_library_size,
+            min_library_size = EXCLUDED.min_library_size,
+            max_library_size = EXCLUDED.max_library_size,
+            avg_zero_fraction = EXCLUDED.avg_zero_fraction,
+            avg_expressed_genes = EXCLUDED.avg_expressed_genes
+        """,
+        (run_id,),
+    )
+
+def refresh_condition_summary(cur, run_id) -> None:
+    """
+    Recompute the kpi_run_condition_summary rows of a single run from its metrics.
+    """
+    cur.execute("DELETE FROM kpi_run_condition_summary WHERE run_id = %s", (run_id,))
+    cur.execute(
+        """
+        INSERT INTO kpi_run_condition_summary (run_id, condition, n_samples, sum_library_size,
+                                               sum_sq_library_size, min_library_size, max_library_size)
+        SELECT q.run_id, COALESCE(s.condition, 'unknown'), COUNT(*),
+               SUM(q.library_size), SUM(q.library_size::NUMERIC * q.library_size),
+               MIN(q.library_size), MAX(q.library_size)
+        FROM qc_metrics q
+        JOIN samples s ON s.sample_id = q.sample_id
+        WHERE q.run_id = %s
+        GROUP BY q.run_id, COALESCE(s.condition, 'unknown')
+        """,
+        (run_id,),
+    )
+
+def insert_dataframe(cur, df, table_name, run_id, upsert=False) -> int:
+    """
+    Insert the rows of df into table_name, keeping only columns known to the table.
+    Samples referenced by df are created first (FK requirement).
+    With upsert=True, rows whose key already exists are updated instead.
+    Returns the number of inserted rows.
+    """
+    df = df.copy()
+
+    # 1. Add samples to 'samples' table if they don't exist (FK requirement)
+    if 'sample_id' in df.columns:
+        sample_query = "INSERT INTO samples (sample_id) VALUES %s ON CONFLICT (sample_id) DO NOTHING"
+        execute_values(cur, sample_query, [(s_id,) for s_id in df['sample_id'].unique()])
+
+    # 2. Inject run_id for metrics
+    df['run_id'] = run_id
+
+    # 3. Filter columns
+    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s", (table_name,))
+    db_columns = [row[0].lower() for row in cur.fetchall()]
+    
+    cols_to_use = [col for col in df.columns if col.lower() in db_columns]
+    if not cols_to_use:
+        print(f"Skipping {table_name}: No matching columns found.")
+        return 0
+
+    valid_df = df[cols_to_use].astype(object)
+    valid_df = valid_df.where(pd.notnull(valid_df), None)
+    cols = ", ".join(valid_df.columns)
+
+    if table_name == 'samples':
+        # This logic says: If the sample_id exists, just update the metadata
+        insert_query = f"""
+            INSERT INTO {table_name} ({cols}) 
+            VALUES %s
+            ON CONFLICT (sample_id) DO UPDATE SET 
+                condition = EXCLUDED.condition,
+                geo_accession = EXCLUDED.geo_accession
+        """
+    elif upsert:
+        # Delta export: replace the metrics of samples already attached to the run
+        keys = CONFLICT_KEYS[table_name]
+        updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in valid_df.columns if c not in keys)
+        insert_query = f"""
+            INSERT INTO {table_name} ({cols})
+            VALUES %s
+            ON CONFLICT ({", ".join(keys)}) DO UPDATE SET {updates}
+        """
+    else:
+        # Standard insert for other tables
+        insert_query = f"INSERT INTO {table_name} ({cols}) VALUES %s"
+
+    execute_values(cur, insert_query, [tuple(row) for row in valid_df.itertuples(index=False)])
+    return len(valid_df)
+
+def insert_postgresql_db(con, csv_path, table_name, dataset_id, version, run_name) -> None:
+    df = pd.read_csv(csv_path)
 
     try:
         with con.cursor() as cur:
-            # 1. Register the Run
-            run_query = """
-                INSERT INTO runs (run_name, pipeline_version, dataset_id) 
-                VALUES (%s, %s, %s) RETURNING run_id
-            """
-            cur.execute(run_query, (run_name, version, dataset_id))
-            active_run_id = cur.fetchone()[0]
-
-            # 2. Add samples to 'samples' table if they don't exist (FK requirement)
-            if 'sample_id' in df.columns:
-                sample_query = "INSERT INTO samples (sample_id) VALUES (%s) ON CONFLICT (sample_id) DO NOTHING"
-                for s_id in df['sample_id'].unique():
-                    cur.execute(sample_query, (s_id,))
-
-            # 3. Inject run_id for metrics
-            df['run_id'] = active_run_id
-
-            # 4. Filter columns
-            cur.execute(f"SELECT column_name FROM information_schema.columns WHERE table_name = '{table_name}'")
-            db_columns = [row[0].lower() for row in cur.fetchall()]
-            
-            cols_to_use = [col for col in df.columns if col.lower() in db_columns]
-            if cols_to_use:
-                valid_df = df[cols_to_use].copy()
-                valid_df = valid_df.where(pd.notnull(valid_df), None)
-                
-                cols = ", ".join(valid_df.columns)
-                placeholders = ", ".join(["%s"] * len(valid_df.columns))
-
-                if table_name == 'samples':
-                    # This logic says: If the sample_id exists, just update the metadata
-                    insert_query = f"""
-                        INSERT INTO {table_name} ({cols}) 
-                        VALUES ({placeholders})
-                        ON CONFLICT (sample_id) DO UPDATE SET 
-                            condition = EXCLUDED.condition,
-                            geo_accession = EXCLUDED.geo_accession
-                    """
-                else:
-                    # Standard insert for other tables
-                    insert_query = f"INSERT INTO {table_name} ({cols}) VALUES ({placeholders})"
-
-                for _, row in valid_df.iterrows():
-                    cur.execute(insert_query, tuple(row))
-                
+            active_run_id = register_run(cur, run_name, version, dataset_id)
+            if insert_dataframe(cur, df, table_name, active_run_id):
                 con.commit()
                 print(f"Successfully inserted into {table_name}")
-            else:
-                print(f"Skipping {table_name}: No matching columns found.")
 
     except Exception as e:
         con.rollback()
@@ -132,36 +285,40 @@ def requests(conn) -> None:
             conn.rollback()
             print(f"Error: {e}")
 
-def run_database():
-    dataset_id = os.getenv("DATASET_ID", "Unknown_Dataset")
-    pipeline_version = os.getenv("PIPELINE_VERSION", "Unknown_Version")
-    run_name = f"Run_{dataset_id}"
-    csv_path = './output/GSE60450_qc/qc_table.csv'
+def run_database(qc_df=None):
+    """
+    Export a QC table to PostgreSQL.
+    When qc_df is None, the table is read back from the pipeline output CSV.
+    """
+    from rnaseq.db_export import BackgroundExporter
 
-    # establish connection
-    conn = connect_database()
+    if qc_df is None:
+        qc_df = pd.read_csv('./output/GSE60450_qc/qc_table.csv')
 
-    try:
-        
-        print("Creating Database Tables")
-        create_tables(conn)  
-
-        # Samples table insertion
-        print("Inserting data")
-        insert_postgresql_db(conn, csv_path, 'samples', dataset_id, pipeline_version, run_name)
-        # QC metrics insertion
-        insert_postgresql_db(conn, csv_path, table_name='qc_metrics', dataset_id=dataset_id, 
-                            version=pipeline_version, 
-                            run_name=run_name)
-    finally:
-        conn.close()
+    with BackgroundExporter() as exporter:
+        exporter.submit_qc_table(qc_df)
 
 def main():
     """
     Main function to run the RNA-seq QC pipeline based on a configuration file.
     Parameters: None
     """
-    run_database()
+    parser = argparse.ArgumentParser(description="RNA-seq QC database")
+    parser.add_argument(
+        "--upgrade",
+        action="store_true",
+        help="Upgrade a database created by an earlier version (one-off, see sql/backfill_kpis.sql)"
+    )
+    args = parser.parse_args()
+
+    if args.upgrade:
+        conn = connect_database()
+        try:
+            upgrade_database(conn)
+        finally:
+            conn.close()
+    else:
+        run_database()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
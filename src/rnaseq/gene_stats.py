@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+"""Per-gene summary statistics over samples.
+
+Statistics are kept in GeneStatsAccumulator objects (count, mean, M2,
+number of zeros and max per gene). A block of sample columns is summarised
+directly, and partial results over disjoint sample sets are combined with
+Chan's parallel update. The table can therefore be built chunk by chunk,
+split across worker processes, or extended with new samples, and every
+path gives the same numerically stable result.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from rnaseq.shared_matrix import SharedMatrixHandle, attach_shared_matrix
+
+ALL_SAMPLES = "all" # group label of the statistics over every sample
+FIELDS = ("mean", "m2", "n_zeros", "max") # per-gene arrays of an accumulator
+
+
+@dataclass
+class GeneStatsAccumulator:
+    """
+    Running per-gene statistics over a set of samples.
+
+    n is the number of samples seen; mean, m2 (sum of squared deviations),
+    n_zeros and max are arrays of length n_genes.
+    """
+    n: int
+    mean: np.ndarray
+    m2: np.ndarray
+    n_zeros: np.ndarray
+    max: np.ndarray
+
+    @classmethod
+    def empty(cls, n_genes: int) -> "GeneStatsAccumulator":
+        return cls(
+            n=0,
+            mean=np.zeros(n_genes),
+            m2=np.zeros(n_genes),
+            n_zeros=np.zeros(n_genes, dtype=np.int64),
+            max=np.full(n_genes, -np.inf),
+        )
+
+    @classmethod
+    def from_block(cls, values: np.ndarray) -> "GeneStatsAccumulator":
+        """Statistics of a (n_genes, n_samples) block."""
+        values = np.asarray(values, dtype=np.float64)
+        if values.shape[1] == 0:
+            return cls.empty(values.shape[0])
+        mean = values.mean(axis=1)
+        return cls(
+            n=values.shape[1],
+            mean=mean,
+            m2=((values - mean[:, None]) ** 2).sum(axis=1),
+            n_zeros=(values == 0).sum(axis=1),
+            max=values.max(axis=1),
+        )
+
+    def merge(self, other: "GeneStatsAccumulator") -> "GeneStatsAccumulator":
+        """Combine with statistics over a disjoint set of samples (Chan et al.)."""
+        n = self.n + other.n
+        if self.n == 0 or other.n == 0:
+            return other if self.n == 0 else self
+        delta = other.mean - self.mean
+        return GeneStatsAccumulator(
+            n=n,
+            mean=self.mean + delta * (other.n / n),
+            m2=self.m2 + other.m2 + delta ** 2 * (self.n * other.n / n),
+            n_zeros=self.n_zeros + other.n_zeros,
+            max=np.maximum(self.max, other.max),
+        )
+
+    @classmethod
+    def concat(cls, parts: list) -> "GeneStatsAccumulator":
+        """Stack statistics of consecutive gene blocks over the same samples."""
+        return cls(
+            n=parts[0].n,
+            mean=np.concatenate([p.mean for p in parts]),
+            m2=np.concatenate([p.m2 for p in parts]),
+            n_zeros=np.concatenate([p.n_zeros for p in parts]),
+            max=np.concatenate([p.max for p in parts]),
+        )
+
+    @property
+    def variance(self) -> np.ndarray:
+        """Sample variance (ddof=1)."""
+        if self.n < 2:
+            return np.full_like(self.mean, np.nan)
+        return self.m2 / (self.n - 1)
+
+    def to_frame(self, gene_ids) -> pd.DataFrame:
+        """
+        Summary table: mean, variance, dispersion (variance / mean),
+        cv (std / mean), zero_fraction (percentage of zero counts) and max per gene.
+        """
+        variance = self.variance
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dispersion = np.where(self.mean > 0, variance / self.mean, np.nan)
+            cv = np.where(self.mean > 0, np.sqrt(variance) / self.mean, np.nan)
+
+        return pd.DataFrame({
+            "n_samples": self.n,
+            "mean": self.mean,
+            "variance": variance,
+            "dispersion": dispersion,
+            "cv": cv,
+            "zero_fraction": self.n_zeros / self.n * 100 if self.n else np.nan,
+            "max": self.max,
+        }, index=pd.Index(gene_ids, name="gene_id"))
+
+
+def accumulate_block(values: np.ndarray, conditions) -> dict:
+    """
+    Statistics of a (n_genes, n_samples) block, overall and per condition.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Counts of a block of genes over a block of samples.
+    conditions : array-like
+        Condition label of each column of values.
+    Returns
+    -------
+    dict
+        {"all": GeneStatsAccumulator, <condition>: GeneStatsAccumulator, ...}
+    """
+    conditions = np.asarray(conditions)
+    groups = {ALL_SAMPLES: GeneStatsAccumulator.from_block(values)}
+    for cond in pd.unique(conditions):
+        groups[cond] = GeneStatsAccumulator.from_block(values[:, conditions == cond])
+    return groups
+
+
+def merge_groups(left: dict, right: dict) -> dict:
+    """Merge two {group: accumulator} dicts computed over disjoint samples."""
+    merged = dict(left)
+    for group, acc in right.items():
+        merged[group] = merged[group].merge(acc) if group in merged else acc
+    return merged
+
+
+def concat_groups(blocks: list) -> dict:
+    """Stack {group: accumulator} dicts of consecutive gene blocks over the same samples."""
+    return {group: GeneStatsAccumulator.concat([b[group] for b in blocks]) for group in blocks[0]}
+
+
+def save_groups(groups: dict, path: str) -> None:
+    """Save a {group: accumulator} dict to a single .npz file."""
+    arrays = {"groups": np.array([str(g) for g in groups]), "n": np.array([acc.n for acc in groups.values()])}
+    for i, acc in enumerate(groups.values()):
+        arrays.update({f"{field}_{i}": getattr(acc, field) for field in FIELDS})
+    np.savez(path, **arrays)
+
+
+def load_groups(path: str) -> dict:
+    """Load a {group: accumulator} dict written by save_groups."""
+    with np.load(path) as data:
+        return {
+            str(group): GeneStatsAccumulator(n=int(data["n"][i]), **{f: data[f"{f}_{i}"] for f in FIELDS})
+            for i, group in enumerate(data["groups"])
+        }
+
+
+def column_chunk_stats(values, col_start: int, col_stop: int, conditions, block_size: int = 5000) -> dict:
+    """
+    Statistics of the columns [col_start, col_stop) of values, read in gene blocks.
+
+    values is an array-like of shape (n_genes, n_samples) or a
+    SharedMatrixHandle, attached to in the worker.
+    """
+    if isinstance(values, SharedMatrixHandle):
+        with attach_shared_matrix(values) as shared_values:
+            return column_chunk_stats(shared_values, col_start, col_stop, conditions, block_size)
+
+    conditions = np.asarray(conditions)[col_start:col_stop]
+    blocks = []
+    for start in range(0, values.shape[0], block_size):
+        stop = min(start + block_size, values.shape[0])
+        blocks.append(accumulate_block(np.asarray(values[start:stop, col_start:col_stop]), conditions))
+
+    return concat_groups(blocks)
+
+
+def worker_context():
+    """Start method of the worker pool: forkserver where available, spawn otherwise."""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def compute_gene_stats(values, sample_conditions, block_size: int = 5000, n_workers: int = 1) -> dict:
+    """
+    Per-gene statistics, overall and per condition.
+
+    Sample columns are split into n_workers contiguous chunks; each chunk is
+    summarised in gene blocks of block_size rows (in a separate process when
+    n_workers > 1) and the partial results are merged with Chan's update.
+    Workers never receive the matrix itself: they attach read-only to the
+    shared matrix described by the handle (see shared_matrix).
+
+    Parameters
+    ----------
+    values : np.ndarray, np.memmap or SharedMatrixHandle
+        Count matrix of shape (n_genes, n_samples), or a shared matrix
+        handle; a handle is required when n_workers > 1.
+    sample_conditions : array-like
+        Condition of each sample, in column order.
+    block_size : int
+        Number of gene rows processed per block.
+    n_workers : int
+        Number of worker processes.
+    Returns
+    -------
+    dict
+        {"all": GeneStatsAccumulator, <condition>: GeneStatsAccumulator, ...}
+    """
+    sample_conditions = list(sample_conditions)
+    n_samples = len(sample_conditions)
+    n_chunks = max(1, min(n_workers, n_samples))
+    bounds = np.linspace(0, n_samples, n_chunks + 1).astype(int)
+    chunks = list(zip(bounds[:-1], bounds[1:]))
+
+    if n_chunks == 1:
+        partials = [column_chunk_stats(values, 0, n_samples, sample_conditions, block_size)]
+    elif not isinstance(values, SharedMatrixHandle):
+        raise ValueError("n_workers > 1 requires a SharedMatrixHandle, see shared_matrix.SharedCountsMatrix")
+    else:
+        # workers are not forked: the pipeline runs the database export thread at the
+        # same time, and a fork would copy its locks and connection in whatever state
+        # they are. A worker crash surfaces here as BrokenProcessPool, the owner of the
+        # block unlinks it
+        with ProcessPoolExecutor(max_workers=n_chunks, mp_context=worker_context()) as pool:
+            futures = [pool.submit(column_chunk_stats, values, start, stop, sample_conditions, block_size)
+                       for start, stop in chunks]
+            partials = [f.result() for f in futures]
+
+    result = partials[0]
+    for partial in partials[1:]:
+        result = merge_groups(result, partial)
+    return result
+
+
+def gene_stats_table(groups: dict, gene_ids) -> pd.DataFrame:
+    """
+    Long-format gene statistics table with one row per (gene_id, group).
+    """
+    frames = [acc.to_frame(gene_ids).assign(group=group) for group, acc in groups.items()]
+    table = pd.concat(frames).reset_index()
+    return table[["gene_id", "group"] + [c for c in table.columns if c not in ("gene_id", "group")]]
+
+
+def save_gene_stats(stats_df: pd.DataFrame, output_dir: str, filename: str = "gene_stats.parquet") -> None:
+    """
+    Save the gene statistics table to Parquet.
+
+    Parameters
+    ----------
+    stats_df : pd.DataFrame
+        Table returned by gene_stats_table.
+    output_dir : str
+        Directory to save the Parquet file.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    stats_df.to_parquet(os.path.join(output_dir, filename), index=False)
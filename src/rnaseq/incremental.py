@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+"""Incremental addition of samples to an existing cohort.
+
+A cohort state directory caches what is needed to extend the QC without
+touching the existing samples again:
+
+- log_counts.f64 : log-transformed counts, column-major (one contiguous
+  column per sample), so new samples are appended at the end of the file.
+- sample_correlation.<generation>.npy : the sample-sample Pearson correlation matrix.
+- sample_moments.<generation>.npz : per-sample mean and centered norm of the log counts.
+- gene_stats.<generation>.npz : per-gene running count statistics, overall and per
+  condition (see gene_stats).
+- cohort_meta.json : gene_ids, sample_ids, the log transform used and the
+  current generation.
+
+An append writes the new log columns past the known ones and the other
+files under the next generation number, then swaps cohort_meta.json
+atomically; the previous generation is only removed after that. A crash
+at any point leaves the state of the last committed generation.
+
+Adding k samples to a cohort of n samples costs O(n_genes * n * k) for the
+new correlation rows instead of O(n_genes * (n + k)^2) for a full rerun.
+"""
+
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+from rnaseq.qc import log_transform, build_qc_table
+from rnaseq.gene_stats import accumulate_block, merge_groups, save_groups, load_groups
+from rnaseq.out_of_core import OnDiskCounts, iter_sample_blocks
+
+LOG_FILE = "log_counts.f64"
+CORR_FILE = "sample_correlation.npy"
+MOMENTS_FILE = "sample_moments.npz"
+GENE_STATS_FILE = "gene_stats.npz"
+META_FILE = "cohort_meta.json"
+GENERATION_FILES = (CORR_FILE, MOMENTS_FILE, GENE_STATS_FILE) # rewritten on every append
+
+
+def read_cohort_meta(state_dir: str) -> dict:
+    with open(os.path.join(state_dir, META_FILE), "r", encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def write_cohort_meta(state_dir: str, meta: dict) -> None:
+    tmp_path = os.path.join(state_dir, META_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump(meta, fh)
+    os.replace(tmp_path, os.path.join(state_dir, META_FILE))
+
+
+def has_cohort_state(state_dir: str) -> bool:
+    return os.path.exists(os.path.join(state_dir, META_FILE))
+
+
+def state_file(state_dir: str, filename: str, meta: dict) -> str:
+    """Path of a state file of the generation recorded in meta."""
+    stem, ext = os.path.splitext(filename)
+    return os.path.join(state_dir, f"{stem}.{meta['generation']}{ext}")
+
+
+def remove_generation(state_dir: str, meta: dict) -> None:
+    for filename in GENERATION_FILES:
+        path = state_file(state_dir, filename, meta)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def commit_cohort_state(state_dir: str, meta: dict) -> None:
+    """
+    Make a state staged by append_samples the current one.
+
+    The meta file is replaced atomically, then the files of the previous
+    generation are removed.
+    """
+    previous = read_cohort_meta(state_dir)
+    write_cohort_meta(state_dir, meta)
+    if previous["generation"] != meta["generation"]:
+        remove_generation(state_dir, previous)
+
+
+def open_log_counts(state_dir: str, meta: dict) -> np.memmap:
+    """Read-only column-major view of the cached log counts."""
+    return np.memmap(
+        os.path.join(state_dir, LOG_FILE),
+        dtype=np.float64,
+        mode="r",
+        shape=(len(meta["gene_ids"]), len(meta["sample_ids"])),
+        order="F",
+    )
+
+
+def column_moments(log_values: np.ndarray) -> tuple:
+    """Per-sample mean and norm of the centered log counts."""
+    mean = log_values.mean(axis=0)
+    norm = np.sqrt(((log_values - mean) ** 2).sum(axis=0))
+    return mean, norm
+
+
+def reset_cohort_state(state_dir: str, gene_ids, sample_ids, base: str) -> tuple:
+    """
+    Invalidate any existing state before it is rebuilt.
+
+    Returns (previous, meta): the meta of the replaced state (None if
+    there was none) and the meta of the new one, at the next generation.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+
+    # the existing state is invalid as soon as its log file is overwritten
+    previous = read_cohort_meta(state_dir) if has_cohort_state(state_dir) else None
+    if previous is not None:
+        os.remove(os.path.join(state_dir, META_FILE))
+    meta = {
+        "base": base,
+        "gene_ids": [g.item() if hasattr(g, "item") else g for g in gene_ids],
+        "sample_ids": list(sample_ids),
+        "generation": previous["generation"] + 1 if previous is not None else 0,
+    }
+    return previous, meta
+
+
+def write_cohort_state(state_dir: str, meta: dict, previous: dict, corr: np.ndarray,
+                       mean: np.ndarray, norm: np.ndarray, gene_stats: dict) -> None:
+    """Write the files of a rebuilt state (the log file is already in place), then its meta."""
+    np.save(state_file(state_dir, CORR_FILE, meta), corr)
+    np.savez(state_file(state_dir, MOMENTS_FILE, meta), mean=mean, norm=norm)
+    save_groups(gene_stats, state_file(state_dir, GENE_STATS_FILE, meta))
+
+    write_cohort_meta(state_dir, meta)
+    if previous is not None and previous["generation"] != meta["generation"]:
+        remove_generation(state_dir, previous)
+
+
+def init_cohort_state(counts_df: pd.DataFrame, corr_df: pd.DataFrame, state_dir: str, gene_stats: dict,
+                      base: str = "log1p") -> None:
+    """
+    Build the cohort state from a full canonical counts DataFrame.
+
+    The correlation computed by qc.qc_all is reused as is, only the log
+    counts file and the per-sample moments are written here.
+
+    Parameters
+    ----------
+    counts_df : pd.DataFrame
+        Canonical counts (gene_id index, sample_id columns).
+    corr_df : pd.DataFrame
+        Sample-sample correlation of the log counts.
+    state_dir : str
+        Directory receiving the cached state.
+    gene_stats : dict
+        {group: GeneStatsAccumulator} of the cohort, see gene_stats.compute_gene_stats.
+    base : str
+        Log transform, see qc.log_transform.
+    """
+    previous, meta = reset_cohort_state(state_dir, counts_df.index, counts_df.columns, base)
+
+    log_values = np.asfortranarray(log_transform(counts_df.to_numpy(dtype=np.float64), base=base))
+    with open(os.path.join(state_dir, LOG_FILE), "wb") as fh:
+        fh.write(log_values.tobytes(order="F"))
+
+    mean, norm = column_moments(log_values)
+    del log_values
+
+    write_cohort_state(state_dir, meta, previous, corr_df.to_numpy(dtype=np.float64), mean, norm, gene_stats)
+
+
+def init_cohort_state_on_disk(counts: OnDiskCounts, log_path: str, corr_df: pd.DataFrame, state_dir: str,
+                              gene_stats: dict, base: str = "log1p", block_size: int = 5000) -> None:
+    """
+    Build the cohort state from the outputs of an out_of_core run.
+
+    The column-major log counts file written by qc_all_out_of_core already
+    has the state layout and is moved into state_dir; the correlation is
+    reused as is, and the per-sample moments are computed in one pass over
+    blocks of sample columns.
+
+    Parameters
+    ----------
+    counts : OnDiskCounts
+        Memory-mapped count matrix (for its gene/sample labels).
+    log_path : str
+        Log counts file written by out_of_core.blocked_log_transform with the same base.
+    corr_df : pd.DataFrame
+        Sample-sample correlation of the log counts.
+    state_dir : str
+        Directory receiving the cached state.
+    gene_stats : dict
+        {group: GeneStatsAccumulator} of the cohort.
+    base : str
+        Log transform used for log_path.
+    block_size : int
+        Sample columns are read in blocks holding about block_size gene rows.
+    """
+    previous, meta = reset_cohort_state(state_dir, counts.gene_ids, counts.sample_ids, base)
+    shutil.move(log_path, os.path.join(state_dir, LOG_FILE))
+
+    log_values = open_log_counts(state_dir, meta)
+    mean = np.empty(counts.shape[1])
+    norm = np.empty(counts.shape[1])
+    for start, stop, block in iter_sample_blocks(log_values, block_size):
+        mean[start:stop], norm[start:stop] = column_moments(block)
+    del log_values
+
+    write_cohort_state(state_dir, meta, previous, corr_df.to_numpy(dtype=np.float64), mean, norm, gene_stats)
+
+
+def load_sample_correlation(state_dir: str) -> pd.DataFrame:
+    """Cached sample-sample correlation as a labelled DataFrame."""
+    meta = read_cohort_meta(state_dir)
+    corr = np.load(state_file(state_dir, CORR_FILE, meta))
+    return pd.DataFrame(corr, index=meta["sample_ids"], columns=meta["sample_ids"])
+
+
+def load_gene_stats(state_dir: str, meta: dict = None) -> dict:
+    """
+    Cached per-gene statistics, {group: GeneStatsAccumulator}, of the
+    current state or of the generation recorded in meta.
+    """
+    return load_groups(state_file(state_dir, GENE_STATS_FILE, meta or read_cohort_meta(state_dir)))
+
+
+def append_samples(state_dir: str, new_counts_df: pd.DataFrame, new_samples_df: pd.DataFrame,
+                   block_size: int = 5000) -> tuple:
+    """
+    Stage the addition of new samples to a cohort state and return their QC rows.
+
+    Only the new columns are transformed; the existing log counts are read
+    once, block by block, to compute the correlation of every existing
+    sample with the new ones. Everything is written under the next
+    generation and the state only advances when the returned meta is
+    passed to commit_cohort_state; until then the current state is intact
+    and the append can simply be run again.
+
+    Parameters
+    ----------
+    state_dir : str
+        Cohort state directory created by init_cohort_state.
+    new_counts_df : pd.DataFrame
+        Canonical counts of the new samples only, same genes as the cohort.
+    new_samples_df : pd.DataFrame
+        Sample annotations of the new samples.
+    block_size : int
+        Number of gene rows read per block from the cached log counts.
+    Returns
+    -------
+    tuple
+        (qc_df, meta): QC summary table for the new samples (see
+        qc.build_qc_table) and the staged cohort meta.
+    """
+    meta = read_cohort_meta(state_dir)
+    old_ids = meta["sample_ids"]
+
+    overlap = set(old_ids) & set(new_counts_df.columns)
+    if overlap:
+        raise ValueError(f"Samples already present in the cohort: {sorted(overlap)}")
+
+    if list(new_counts_df.index) != meta["gene_ids"]:
+        raise ValueError("Gene IDs of the new samples do not match the cohort genes")
+
+    qc_df = build_qc_table(new_counts_df, new_samples_df)
+    qc_df.index.name = "sample_id"
+
+    new_log = log_transform(new_counts_df.to_numpy(dtype=np.float64), base=meta["base"])
+    new_mean, new_norm = column_moments(new_log)
+    new_centered = new_log - new_mean
+
+    with np.load(state_file(state_dir, MOMENTS_FILE, meta)) as moments:
+        old_mean, old_norm = moments["mean"], moments["norm"]
+
+    # cross products of existing samples with the centered new ones:
+    # sum_g (x_old - mean_old) * xc_new == sum_g x_old * xc_new, since xc_new sums to zero
+    old_log = open_log_counts(state_dir, meta)
+    cross = np.zeros((len(old_ids), new_log.shape[1]))
+    for start in range(0, old_log.shape[0], block_size):
+        stop = min(start + block_size, old_log.shape[0])
+        cross += np.asarray(old_log[start:stop]).T @ new_centered[start:stop]
+    del old_log
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        old_new = np.clip(cross / np.outer(old_norm, new_norm), -1.0, 1.0)
+        new_new = np.clip((new_centered.T @ new_centered) / np.outer(new_norm, new_norm), -1.0, 1.0)
+
+    old_corr = np.load(state_file(state_dir, CORR_FILE, meta))
+    corr = np.block([[old_corr, old_new], [old_new.T, new_new]])
+
+    new_conditions = new_samples_df.set_index("sample_id").loc[new_counts_df.columns, "condition"]
+    gene_stats = merge_groups(load_gene_stats(state_dir, meta),
+                              accumulate_block(new_counts_df.to_numpy(), new_conditions))
+
+    staged = dict(meta, sample_ids=old_ids + list(new_counts_df.columns), generation=meta["generation"] + 1)
+
+    # appending columns to a column-major file leaves the existing bytes untouched;
+    # seek past the known columns so leftovers of an uncommitted append are overwritten
+    with open(os.path.join(state_dir, LOG_FILE), "r+b") as fh:
+        fh.seek(len(meta["gene_ids"]) * len(old_ids) * np.dtype(np.float64).itemsize)
+        fh.write(np.asfortranarray(new_log).tobytes(order="F"))
+        fh.truncate()
+    np.save(state_file(state_dir, CORR_FILE, staged), corr)
+    np.savez(state_file(state_dir, MOMENTS_FILE, staged),
+             mean=np.concatenate([old_mean, new_mean]),
+             norm=np.concatenate([old_norm, new_norm]))
+    save_groups(gene_stats, state_file(state_dir, GENE_STATS_FILE, staged))
+
+    return qc_df, staged
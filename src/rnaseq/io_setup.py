@@ -3,6 +3,8 @@ import re
 import pandas as pd
 import numpy as np
 
+ANNOTATION_COLUMNS = ["Length", "Chr", "Start", "End", "Strand"] # optional featureCounts annotation columns
+
 def normalize_and_validate_counts(counts_df: pd.DataFrame) -> pd.DataFrame:
     """
     Validate counts matrix canonical format:
@@ -84,6 +86,57 @@ def normalize_and_validate_samples(samples_df: pd.DataFrame, counts_df: pd.DataF
 
     return samples_df
 
+def extract_sample_ids(columns, pattern: str) -> list:
+    """
+    Extract biological sample IDs from raw count column names.
+
+    Parameters:
+    - columns: iterable of str : Raw column names of the count file.
+    - pattern: str : Regular expression whose first group is the sample ID.
+    Returns:
+    - list[str] : Extracted sample IDs, in the same order as columns.
+    """
+    if pattern is None:
+        raise ValueError("A pattern must be provided to extract sample IDs from column names.")
+    sample_ids = []
+    for col in columns:  
+        r_match = re.search(pattern, col)
+        if not r_match:
+            raise ValueError(f"The following sample {col} does not match the expected pattern {pattern}.")
+        sample_ids.append(r_match.group(1))
+
+    # Ensure no duplicate sample IDs
+    if len(set(sample_ids)) != len(sample_ids):
+        raise ValueError("Duplicate sample IDs found after extraction.")
+
+    return sample_ids
+
+def read_count_header(file_path: str, pattern: str, sep='\t',
+                      gene_id_candidates = ["EntrezGeneID", "GeneID", "gene_id"]) -> tuple:
+    """
+    Locate the gene ID and sample columns of a count file from its header only.
+
+    Parameters:
+    - file_path: str : Path to the input file.
+    - pattern: str : Regular expression pattern to extract biological sample IDs.
+    - sep: str : Delimiter used in the input file (default is tab).
+    - gene_id_candidates: list[str] : List of possible gene ID column names.
+    Returns:
+    - tuple : (gene_id_col, raw_columns, sample_ids) with raw_columns the count
+      columns as named in the file and sample_ids the extracted IDs, in file order.
+    """
+    header = pd.read_csv(file_path, sep=sep, index_col=0, nrows=0)
+
+    gene_id_candidates = list(gene_id_candidates)
+    gene_id_col = next((c for c in gene_id_candidates if c in header.columns), None)
+    if gene_id_col is None:
+        raise ValueError(
+            f"No gene identifier column found. Expected one of {gene_id_candidates}. You may need to specify the correct gene_id_candidates parameter."
+        )
+
+    raw_columns = [c for c in header.columns if c != gene_id_col and c not in ANNOTATION_COLUMNS]
+    return gene_id_col, raw_columns, extract_sample_ids(raw_columns, pattern)
+
 def load_counts_tsv(file_path: str, pattern: str , sep='\t',gene_id_candidates = ["EntrezGeneID", "GeneID", "gene_id"]) -> pd.DataFrame:
     """
     Load RNA-seq count data from a tab-delimited file and process sample IDs.
@@ -109,7 +162,7 @@ def load_counts_tsv(file_path: str, pattern: str , sep='\t',gene_id_candidates =
 
     # Drop unnecessary columns and rename gene ID column
     # drop optional annotation columns
-    for col in ["Length", "Chr", "Start", "End", "Strand"]:
+    for col in ANNOTATION_COLUMNS:
         if col in counts_df.columns:
             counts_df.drop(columns=col, inplace=True)
     
@@ -118,21 +171,35 @@ def load_counts_tsv(file_path: str, pattern: str , sep='\t',gene_id_candidates =
     counts_df.index.name = "gene_id"
 
     # Extract biological sample IDs using the provided pattern
+    counts_df.columns = extract_sample_ids(counts_df.columns, pattern)
+    counts_df = counts_df.astype(np.int64)
+    return normalize_and_validate_counts(counts_df)
 
-    if pattern is None:
-        raise ValueError("A pattern must be provided to extract sample IDs from column names.")
-    sample_ids = []
-    for col in counts_df.columns:  
-        r_match = re.search(pattern, col)
-        if not r_match:
-            raise ValueError(f"The following sample {col} does not match the expected pattern {pattern}.")
-        sample_ids.append(r_match.group(1))
+def load_new_sample_columns(file_path: str, pattern: str, known_sample_ids, sep='\t',
+                            gene_id_candidates = ["EntrezGeneID", "GeneID", "gene_id"]) -> pd.DataFrame:
+    """
+    Load only the sample columns of a count file that are not already known.
 
-    # Ensure no duplicate sample IDs
-    if len(set(sample_ids)) != len(sample_ids):
-        raise ValueError("Duplicate sample IDs found after extraction.")
-    
-    counts_df.columns = sample_ids
+    Parameters:
+    - file_path: str : Path to the input file.
+    - pattern: str : Regular expression pattern to extract biological sample IDs.
+    - known_sample_ids: iterable of str : Sample IDs already processed.
+    - sep: str : Delimiter used in the input file (default is tab).
+    - gene_id_candidates: list[str] : List of possible gene ID column names.
+    Returns:
+    - pd.DataFrame : Canonical counts (gene_id index) restricted to the new samples.
+      Has no columns when every sample is already known.
+    """
+    gene_id_col, raw_columns, sample_ids = read_count_header(file_path, pattern, sep, gene_id_candidates)
+
+    known = set(known_sample_ids)
+    new_columns = [raw for raw, sid in zip(raw_columns, sample_ids) if sid not in known]
+    new_ids = [sid for sid in sample_ids if sid not in known]
+
+    counts_df = pd.read_csv(file_path, sep=sep, usecols=[gene_id_col] + new_columns)
+    counts_df = counts_df.set_index(gene_id_col)[new_columns] # keep file column order
+    counts_df.index.name = "gene_id"
+    counts_df.columns = new_ids
     counts_df = counts_df.astype(np.int64)
     return normalize_and_validate_counts(counts_df)
 
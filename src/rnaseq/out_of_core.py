@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+"""Out-of-core QC for count matrices larger than RAM.
+
+The count matrix is stored as a row-major int64 memory-mapped file
+(genes x samples) and every statistic is computed by iterating over
+blocks of genes, so memory use is bounded by the block size instead of
+the cohort size.
+"""
+
+import json
+import os
+from dataclasses import dataclass
+
+import matplotlib.cbook as cbook
+import numpy as np
+import pandas as pd
+
+from rnaseq.io_setup import read_count_header
+from rnaseq.qc import (
+    log_transform,
+    draw_library_size,
+    draw_log_boxplot,
+    draw_correlation_heatmap,
+    save_qc_table,
+)
+
+COUNTS_FILE = "counts.int64"
+LOG_FILE = "log_counts.f64"
+META_FILE = "counts_meta.json"
+
+
+@dataclass
+class OnDiskCounts:
+    """
+    Memory-mapped count matrix with its gene/sample labels.
+
+    values is a read-only np.memmap of shape (n_genes, n_samples).
+    """
+    values: np.memmap
+    gene_ids: pd.Index
+    sample_ids: pd.Index
+
+    @property
+    def shape(self) -> tuple:
+        return self.values.shape
+
+
+def write_meta(out_dir: str, gene_ids, sample_ids) -> None:
+    meta = {
+        "n_genes": len(gene_ids),
+        "n_samples": len(sample_ids),
+        "gene_ids": [g.item() if hasattr(g, "item") else g for g in gene_ids],
+        "sample_ids": list(sample_ids),
+    }
+    with open(os.path.join(out_dir, META_FILE), "w", encoding="utf-8") as fh:
+        json.dump(meta, fh)
+
+
+def open_counts_memmap(out_dir: str) -> OnDiskCounts:
+    """
+    Re-open a count matrix previously written by load_counts_tsv_memmap
+    or counts_to_memmap.
+    """
+    with open(os.path.join(out_dir, META_FILE), "r", encoding="utf-8") as fh:
+        meta = json.load(fh)
+
+    values = np.memmap(
+        os.path.join(out_dir, COUNTS_FILE),
+        dtype=np.int64,
+        mode="r",
+        shape=(meta["n_genes"], meta["n_samples"]),
+    )
+    return OnDiskCounts(
+        values=values,
+        gene_ids=pd.Index(meta["gene_ids"], name="gene_id"),
+        sample_ids=pd.Index(meta["sample_ids"]),
+    )
+
+
+def counts_to_memmap(counts_df: pd.DataFrame, out_dir: str) -> OnDiskCounts:
+    """
+    Write an in-memory canonical counts DataFrame to the on-disk layout.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    values = np.memmap(
+        os.path.join(out_dir, COUNTS_FILE),
+        dtype=np.int64,
+        mode="w+",
+        shape=counts_df.shape,
+    )
+    values[:] = counts_df.to_numpy(dtype=np.int64)
+    values.flush()
+    del values
+
+    write_meta(out_dir, counts_df.index, counts_df.columns)
+    return open_counts_memmap(out_dir)
+
+
+def load_counts_tsv_memmap(file_path: str, pattern: str, out_dir: str, sep='\t',
+                           gene_id_candidates=["EntrezGeneID", "GeneID", "gene_id"],
+                           block_size: int = 5000, on_block=None) -> OnDiskCounts:
+    """
+    Stream a tab-delimited count file into a memory-mapped matrix.
+
+    Same input contract as io_setup.load_counts_tsv, but the file is read
+    block_size rows at a time and appended to out_dir/counts.int64, so the
+    full matrix never has to fit in memory.
+
+    Parameters:
+    - file_path: str : Path to the input file.
+    - pattern: str : Regular expression pattern to extract biological sample IDs.
+    - out_dir: str : Directory receiving the memory-mapped matrix and its metadata.
+    - sep: str : Delimiter used in the input file (default is tab).
+    - gene_id_candidates: list[str] : List of possible gene ID column names.
+    - block_size: int : Number of gene rows read per block.
+    - on_block: callable, optional : Called with each validated int64 block
+      (genes x samples), so other per-gene statistics share the single read.
+    Returns:
+    - OnDiskCounts : Read-only memory-mapped counts with gene/sample labels.
+    """
+    gene_id_col, raw_columns, sample_ids = read_count_header(file_path, pattern, sep, gene_id_candidates)
+
+    os.makedirs(out_dir, exist_ok=True)
+    gene_ids = []
+    reader = pd.read_csv(file_path, sep=sep, usecols=[gene_id_col] + raw_columns, chunksize=block_size)
+
+    with open(os.path.join(out_dir, COUNTS_FILE), "wb") as out:
+        for chunk in reader:
+            if chunk[gene_id_col].isna().any():
+                raise ValueError("counts_df contains missing gene_id in index")
+            block = chunk[raw_columns]
+            if block.isna().any().any():
+                raise ValueError("Missing values found in counts_df")
+            if not all(pd.api.types.is_integer_dtype(block[c]) for c in raw_columns):
+                raise ValueError("Counts must be integer-valued")
+            values = block.to_numpy(dtype=np.int64)
+            if (values < 0).any():
+                raise ValueError("Counts must be non-negative")
+
+            gene_ids.extend(chunk[gene_id_col].tolist())
+            out.write(np.ascontiguousarray(values).tobytes())
+            if on_block is not None:
+                on_block(values)
+
+    if not pd.Index(gene_ids).is_unique:
+        raise ValueError("Gene IDs are not unique in counts_df index")
+
+    write_meta(out_dir, gene_ids, sample_ids)
+    return open_counts_memmap(out_dir)
+
+
+def iter_gene_blocks(values: np.ndarray, block_size: int):
+    """
+    Yield (start, stop, block) over consecutive blocks of gene rows.
+    """
+    if block_size < 1:
+        raise ValueError("block_size must be >= 1")
+    for start in range(0, values.shape[0], block_size):
+        stop = min(start + block_size, values.shape[0])
+        yield start, stop, np.asarray(values[start:stop])
+
+
+def iter_sample_blocks(values: np.ndarray, block_size: int):
+    """
+    Yield (start, stop, block) over blocks of whole sample columns.
+
+    The block width is chosen so that one column block holds about as many
+    values as one gene block of block_size rows.
+    """
+    n_genes, n_samples = values.shape
+    width = max(1, (block_size * n_samples) // max(n_genes, 1))
+    for start in range(0, n_samples, width):
+        stop = min(start + width, n_samples)
+        yield start, stop, np.asarray(values[:, start:stop])
+
+
+def blocked_qc_table(counts: OnDiskCounts, samples_df: pd.DataFrame, block_size: int = 5000) -> pd.DataFrame:
+    """
+    Blocked equivalent of qc.build_qc_table.
+
+    Parameters
+    ----------
+    counts : OnDiskCounts
+        Memory-mapped count matrix.
+    samples_df : pd.DataFrame
+        DataFrame containing sample annotations.
+    block_size : int
+        Number of gene rows processed per block.
+    Returns
+    -------
+    pd.DataFrame
+        QC summary table with metrics for each sample.
+    """
+    n_genes, n_samples = counts.shape
+    lib_size = np.zeros(n_samples, dtype=np.int64)
+    n_zeros = np.zeros(n_samples, dtype=np.int64)
+    n_expressed = np.zeros(n_samples, dtype=np.int64)
+
+    for _, _, block in iter_gene_blocks(counts.values, block_size):
+        lib_size += block.sum(axis=0)
+        n_zeros += (block == 0).sum(axis=0)
+        n_expressed += (block > 0).sum(axis=0)
+
+    samples_df = samples_df.set_index("sample_id").loc[counts.sample_ids]
+
+    qc_df = samples_df.copy()
+    qc_df["library_size"] = lib_size
+    qc_df["zero_fraction"] = np.round(n_zeros / n_genes * 100, 2)
+    qc_df["expressed_genes"] = n_expressed
+
+    if qc_df.isna().any().any():
+        raise ValueError("QC table contains missing values")
+
+    return qc_df
+
+
+def blocked_log_transform(counts: OnDiskCounts, out_path: str, base: str = "log1p",
+                          block_size: int = 5000) -> np.memmap:
+    """
+    Log-transform counts block by block into a float64 memory-mapped file.
+
+    The file is column-major, so both gene blocks (a contiguous run per
+    sample) and whole sample columns are read sequentially.
+    """
+    log_values = np.memmap(out_path, dtype=np.float64, mode="w+", shape=counts.shape, order="F")
+    for start, stop, block in iter_gene_blocks(counts.values, block_size):
+        log_values[start:stop] = log_transform(block, base=base)
+    log_values.flush()
+    return log_values
+
+
+def blocked_sample_correlation(log_values: np.ndarray, sample_ids, block_size: int = 5000) -> pd.DataFrame:
+    """
+    Pearson sample-sample correlation of log counts, accumulated over gene blocks.
+
+    Two passes are made: one for the per-sample means, one accumulating the
+    centered cross-product matrix, so the result matches DataFrame.corr().
+    """
+    n_genes, n_samples = log_values.shape
+
+    col_sum = np.zeros(n_samples)
+    for _, _, block in iter_gene_blocks(log_values, block_size):
+        col_sum += block.sum(axis=0)
+    mean = col_sum / n_genes
+
+    cross = np.zeros((n_samples, n_samples))
+    for _, _, block in iter_gene_blocks(log_values, block_size):
+        centered = block - mean
+        cross += centered.T @ centered
+
+    norm = np.sqrt(np.diag(cross))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr = cross / np.outer(norm, norm)
+    corr = np.clip(corr, -1.0, 1.0)
+
+    return pd.DataFrame(corr, index=sample_ids, columns=sample_ids)
+
+
+def blocked_pca(log_values: np.ndarray, sample_ids, block_size: int = 5000, n_components: int = None) -> dict:
+    """
+    PCA of samples (observations) over genes (features) through the sample Gram matrix.
+
+    Each gene block is centered across samples and its contribution
+    Xc_b.T @ Xc_b is added to an n_samples x n_samples Gram matrix, whose
+    eigen-decomposition gives the same non-zero eigenvalues and sample
+    scores as the gene covariance matrix without ever forming it.
+    Only the first n_components scores are kept (all when None).
+    """
+    n_samples = log_values.shape[1]
+
+    gram = np.zeros((n_samples, n_samples))
+    for _, _, block in iter_gene_blocks(log_values, block_size):
+        centered = block - block.mean(axis=1, keepdims=True)
+        gram += centered.T @ centered
+
+    e_vals, e_vecs = np.linalg.eigh(gram)
+    idx = np.argsort(e_vals)[::-1]
+    e_vals = np.clip(e_vals[idx], 0.0, None)
+    e_vecs = e_vecs[:, idx]
+
+    # deterministic sign: largest absolute entry of each component is positive
+    signs = np.sign(e_vecs[np.abs(e_vecs).argmax(axis=0), np.arange(n_samples)])
+    signs[signs == 0] = 1.0
+    e_vecs = e_vecs * signs
+
+    n_components = n_samples if n_components is None else min(n_components, n_samples)
+    scores = e_vecs[:, :n_components] * np.sqrt(e_vals[:n_components])
+    eigvals = e_vals / (n_samples - 1)
+
+    return {
+        'eigvals' : eigvals,
+        'Variance_expliquee' : eigvals / eigvals.sum(),
+        'Scores' : pd.DataFrame(scores, index=pd.Index(sample_ids, name="sample_id"),
+                                columns=[f"PC{i + 1}" for i in range(n_components)]),
+    }
+
+
+def save_pca(pca: dict, output_dir: str) -> None:
+    """
+    Save the PCA sample scores (pca_scores.csv) and the explained variance
+    of every component (pca_variance.csv).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    pca["Scores"].to_csv(os.path.join(output_dir, "pca_scores.csv"))
+    pd.DataFrame({
+        "component": [f"PC{i + 1}" for i in range(len(pca["eigvals"]))],
+        "eigval": pca["eigvals"],
+        "explained_variance": pca["Variance_expliquee"],
+    }).to_csv(os.path.join(output_dir, "pca_variance.csv"), index=False)
+
+
+def blocked_boxplot_stats(log_values: np.ndarray, sample_ids, block_size: int = 5000) -> list:
+    """
+    Per-sample boxplot statistics of log counts, read in blocks of sample columns.
+    """
+    box_stats = []
+    for start, stop, block in iter_sample_blocks(log_values, block_size):
+        box_stats.extend(cbook.boxplot_stats(block, labels=sample_ids[start:stop]))
+    return box_stats
+
+
+def qc_all_out_of_core(counts: OnDiskCounts, samples_df: pd.DataFrame, output_dir: str, log_path: str,
+                       block_size: int = 5000, base: str = "log1p", n_components: int = 10,
+                       exporter=None) -> tuple:
+    """
+    Out-of-core counterpart of qc.qc_all, producing the same plots and QC table,
+    plus the PCA of the samples (pca_scores.csv, pca_variance.csv).
+
+    Counts are log-transformed once into log_path; the boxplot, correlation
+    and PCA are all computed from that file.
+
+    Parameters
+    ----------
+    counts : OnDiskCounts
+        Memory-mapped count matrix.
+    samples_df : pd.DataFrame
+        DataFrame containing sample annotations.
+    output_dir : str
+        Directory to save QC output files.
+    log_path : str
+        File receiving the log-transformed counts (see blocked_log_transform).
+    block_size : int
+        Number of gene rows processed per block.
+    base : str
+        Log transform, see qc.log_transform.
+    n_components : int
+        Number of principal components whose scores are saved.
+    exporter : BackgroundExporter, optional
+        When given, the QC table is handed to it before the plots are rendered.
+    Returns
+    -------
+    tuple
+        (qc_df, corr_df): the QC table and the sample correlation matrix,
+        which incremental.init_cohort_state_on_disk reuses with log_path.
+    """
+    qc_dir = os.path.join(output_dir, "qc")
+
+    qc_df = blocked_qc_table(counts, samples_df, block_size)
+    qc_df.index.name = "sample_id"
+    if exporter is not None:
+        exporter.submit_qc_table(qc_df)
+    save_qc_table(qc_df, output_dir)
+
+    log_values = blocked_log_transform(counts, log_path, base=base, block_size=block_size)
+
+    draw_library_size(qc_df["library_size"], samples_df, qc_dir)
+    draw_log_boxplot(blocked_boxplot_stats(log_values, counts.sample_ids, block_size), qc_dir)
+    corr_df = blocked_sample_correlation(log_values, counts.sample_ids, block_size)
+    draw_correlation_heatmap(corr_df, qc_dir)
+    save_pca(blocked_pca(log_values, counts.sample_ids, block_size, n_components=n_components), output_dir)
+
+    return qc_df, corr_df
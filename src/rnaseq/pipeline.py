@@ -6,10 +6,15 @@
 import argparse
 from pathlib import Path
 import yaml
-from rnaseq.io_setup import load_counts_tsv, load_samples_geo_series
+import pandas as pd
+from rnaseq.io_setup import load_counts_tsv, load_samples_geo_series, load_new_sample_columns, normalize_and_validate_samples, read_count_header
 from rnaseq.validation import validate_counts, validate_samples
-from rnaseq.qc import qc_all
-from rnaseq.db_setup import run_database
+from rnaseq.qc import qc_all, save_qc_table
+from rnaseq.incremental import init_cohort_state, init_cohort_state_on_disk, has_cohort_state, read_cohort_meta, append_samples, commit_cohort_state, load_gene_stats
+from rnaseq.out_of_core import LOG_FILE, load_counts_tsv_memmap, qc_all_out_of_core
+from rnaseq.gene_stats import accumulate_block, concat_groups, compute_gene_stats, gene_stats_table, save_gene_stats
+from rnaseq.shared_matrix import SharedCountsMatrix, shared_matrix_frame
+from rnaseq.db_export import BackgroundExporter
 
 
 def load_config(config_path: str) -> dict:
@@ -59,10 +64,16 @@ def validate_config_structure(config: dict) -> None:
     if missing:
         raise ValueError(f"Missing required config sections: {missing}")
 
-def run_pipeline(config_path : str) -> None:
+def run_pipeline(config_path : str, exporter=None) -> None:
     """
     Run the RNA-seq QC pipeline based on a configuration file.
 
+    Parameters
+    ----------
+    config_path : str
+        Path to the YAML configuration file.
+    exporter : BackgroundExporter, optional
+        Receives the QC table as soon as it is built.
     """
     config = load_config(config_path)
     validate_config_structure(config)
@@ -70,6 +81,10 @@ def run_pipeline(config_path : str) -> None:
     counts_cfg = config["input"]["counts"]
     samples_cfg = config["input"]["samples"]
 
+    execution_cfg = config["qc"].get("execution", {})
+    if execution_cfg.get("mode", "in_memory") == "out_of_core":
+        run_out_of_core(config, execution_cfg, exporter=exporter)
+        return
 
     counts_df = load_counts_tsv(
         file_path=counts_cfg["path"],
@@ -88,7 +103,212 @@ def run_pipeline(config_path : str) -> None:
     validate_counts(counts_df)
     validate_samples(samples_df, expected_conditions=set(samples_cfg["expected_conditions"]))
 
-    qc_all(counts_df, samples_df, output_dir=config["output"]["base_dir"])
+    gene_stats_cfg = config["qc"].get("gene_stats", {})
+    if gene_stats_cfg.get("enabled", False) and int(gene_stats_cfg.get("n_workers", 1)) > 1:
+        # the counts are moved into shared memory once: every stage reads them through
+        # a zero-copy view and the gene-stats workers attach to the same block
+        with SharedCountsMatrix.from_dataframe(counts_df) as shared:
+            del counts_df
+            run_in_memory(shared_matrix_frame(shared.values, shared.handle), shared.handle,
+                          samples_df, config, exporter)
+    else:
+        run_in_memory(counts_df, counts_df.to_numpy(), samples_df, config, exporter)
+
+def run_in_memory(counts_df: pd.DataFrame, values, samples_df: pd.DataFrame, config: dict, exporter=None) -> None:
+    """
+    Run the QC stages on a loaded counts DataFrame.
+
+    Parameters
+    ----------
+    counts_df : pd.DataFrame
+        Canonical counts (gene_id index, sample_id columns).
+    values : np.ndarray or SharedMatrixHandle
+        The same counts as handed to the gene statistics stage.
+    samples_df : pd.DataFrame
+        Sample annotations, in column order.
+    config : dict
+        Parsed pipeline configuration.
+    exporter : BackgroundExporter, optional
+        Receives the QC table as soon as it is built.
+    """
+    base = config["qc"].get("log_transform", "log1p")
+    _, corr_df = qc_all(counts_df, samples_df, output_dir=config["output"]["base_dir"], exporter=exporter,
+                        base=base)
+    gene_stats = run_gene_stats(values, counts_df.index, samples_df, config)
+
+    incremental_cfg = config.get("incremental", {})
+    if incremental_cfg.get("state_dir"):
+        if gene_stats is None:
+            gene_stats = accumulate_block(counts_df.to_numpy(), samples_df["condition"])
+        init_cohort_state(counts_df, corr_df, incremental_cfg["state_dir"], gene_stats, base=base)
+
+def run_append(config_path: str, exporter=None) -> None:
+    """
+    Add the samples of the counts file that are not yet in the cohort state.
+
+    Only the new sample columns are loaded; their QC rows are added to
+    qc_table.csv and handed to the exporter, the cached correlation matrix
+    and per-gene statistics are extended, and gene_stats.parquet is
+    rewritten from the updated statistics.
+
+    The cohort state only advances once the exporter has committed the new
+    rows: the exporter is closed here, and if the export fails the state is
+    left as it was, so rerunning the append exports the same samples again.
+
+    Parameters
+    ----------
+    config_path : str
+        Path to the YAML configuration file.
+    exporter : BackgroundExporter, optional
+        Receives the QC rows of the new samples (created with append=True).
+    """
+    config = load_config(config_path)
+    validate_config_structure(config)
+
+    counts_cfg = config["input"]["counts"]
+    incremental_cfg = config.get("incremental", {})
+    state_dir = incremental_cfg.get("state_dir")
+    if not state_dir or not has_cohort_state(state_dir):
+        raise ValueError("No cohort state found: run the pipeline once without --append with incremental.state_dir set")
+
+    known_sample_ids = read_cohort_meta(state_dir)["sample_ids"]
+    new_counts_df = load_new_sample_columns(
+        file_path=counts_cfg["path"],
+        pattern=counts_cfg["counts_pattern"],
+        known_sample_ids=known_sample_ids,
+        sep=counts_cfg.get("sep","\t"),
+        gene_id_candidates=counts_cfg.get("gene_id_candidates",
+        ["EntrezGeneID", "GeneID", "gene_id"])
+    )
+    if new_counts_df.empty:
+        print("No new samples to add.")
+        return
+
+    # the condition checks apply to the cohort as a whole, not to the new samples alone
+    all_samples_df = pd.read_csv(incremental_cfg["samples_path"])
+    cohort_samples_df = all_samples_df[all_samples_df["sample_id"].isin([*known_sample_ids, *new_counts_df.columns])]
+    validate_counts(new_counts_df)
+    validate_samples(cohort_samples_df, expected_conditions=set(config["input"]["samples"]["expected_conditions"]))
+    samples_df = all_samples_df[all_samples_df["sample_id"].isin(new_counts_df.columns)]
+    samples_df = normalize_and_validate_samples(samples_df, new_counts_df)
+
+    block_size = int(config["qc"].get("execution", {}).get("block_size", 5000))
+    qc_delta, staged_meta = append_samples(state_dir, new_counts_df, samples_df, block_size=block_size)
+    if exporter is not None:
+        exporter.submit_qc_table(qc_delta)
+
+    output_dir = config["output"]["base_dir"]
+    qc_path = Path(output_dir) / "qc_table.csv"
+    qc_table = qc_delta
+    if qc_path.exists(): # rows of an earlier, uncommitted attempt are replaced
+        previous = pd.read_csv(qc_path, index_col="sample_id")
+        qc_table = pd.concat([previous.drop(index=qc_delta.index, errors="ignore"), qc_delta])
+    save_qc_table(qc_table, output_dir)
+    if config["qc"].get("gene_stats", {}).get("enabled", False):
+        save_gene_stats(gene_stats_table(load_gene_stats(state_dir, staged_meta), staged_meta["gene_ids"]), output_dir)
+
+    if exporter is not None:
+        exporter.close() # raises if the export failed: the state is not committed
+    commit_cohort_state(state_dir, staged_meta)
+    print(f"Added {new_counts_df.shape[1]} samples: {list(new_counts_df.columns)}")
+
+def run_out_of_core(config: dict, execution_cfg: dict, exporter=None) -> None:
+    """
+    Run the QC stages on a memory-mapped count matrix, block by block.
+
+    Parameters
+    ----------
+    config : dict
+        Parsed pipeline configuration.
+    execution_cfg : dict
+        The qc.execution section (block_size, workdir).
+    exporter : BackgroundExporter, optional
+        Receives the QC table as soon as it is built.
+    """
+    counts_cfg = config["input"]["counts"]
+    samples_cfg = config["input"]["samples"]
+    output_dir = config["output"]["base_dir"]
+    block_size = int(execution_cfg.get("block_size", 5000))
+
+    counts_dir = execution_cfg.get("workdir", str(Path(output_dir) / "out_of_core"))
+    _, _, sample_ids = read_count_header(
+        file_path=counts_cfg["path"],
+        pattern=counts_cfg["counts_pattern"],
+        sep=counts_cfg.get("sep","\t"),
+        gene_id_candidates=counts_cfg.get("gene_id_candidates",
+        ["EntrezGeneID", "GeneID", "gene_id"])
+    )
+
+    samples_df = load_samples_geo_series(
+        sample_file=samples_cfg["path"],
+        counts_df=pd.DataFrame(columns=sample_ids), # only the sample labels are needed
+        samples_pattern=samples_cfg["samples_pattern"]
+    )
+
+    validate_samples(samples_df, expected_conditions=set(samples_cfg["expected_conditions"]))
+
+    gene_stats_enabled = config["qc"].get("gene_stats", {}).get("enabled", False)
+    state_dir = config.get("incremental", {}).get("state_dir")
+    gene_stats_blocks = []
+    conditions = samples_df["condition"].to_numpy()
+
+    def accumulate(block): # per-gene statistics ride along the single read of the file
+        gene_stats_blocks.append(accumulate_block(block, conditions))
+
+    counts = load_counts_tsv_memmap(
+        file_path=counts_cfg["path"],
+        pattern=counts_cfg["counts_pattern"],
+        out_dir=counts_dir,
+        sep=counts_cfg.get("sep","\t"),
+        gene_id_candidates=counts_cfg.get("gene_id_candidates",
+        ["EntrezGeneID", "GeneID", "gene_id"]),
+        block_size=block_size,
+        on_block=accumulate if gene_stats_enabled or state_dir else None
+    )
+
+    base = config["qc"].get("log_transform", "log1p")
+    log_path = str(Path(counts_dir) / LOG_FILE)
+    _, corr_df = qc_all_out_of_core(counts, samples_df, output_dir=output_dir, log_path=log_path,
+                                    block_size=block_size, base=base, exporter=exporter)
+    gene_stats = concat_groups(gene_stats_blocks) if gene_stats_blocks else None
+    if gene_stats_enabled:
+        save_gene_stats(gene_stats_table(gene_stats, counts.gene_ids), output_dir)
+
+    if state_dir:
+        init_cohort_state_on_disk(counts, log_path, corr_df, state_dir, gene_stats, base=base, block_size=block_size)
+
+def run_gene_stats(values, gene_ids, samples_df, config: dict):
+    """
+    Compute the per-gene statistics table and save it as gene_stats.parquet.
+
+    Parameters
+    ----------
+    values : np.ndarray or SharedMatrixHandle
+        Count matrix (genes x samples); a shared matrix handle when
+        qc.gene_stats.n_workers > 1.
+    gene_ids : array-like
+        Gene identifiers, in row order.
+    samples_df : pd.DataFrame
+        Sample annotations, in column order.
+    config : dict
+        Parsed pipeline configuration (qc.gene_stats section).
+    Returns
+    -------
+    dict or None
+        {group: GeneStatsAccumulator}, None when the stage is disabled.
+    """
+    gene_stats_cfg = config["qc"].get("gene_stats", {})
+    if not gene_stats_cfg.get("enabled", False):
+        return None
+
+    groups = compute_gene_stats(
+        values,
+        samples_df["condition"],
+        block_size=int(config["qc"].get("execution", {}).get("block_size", 5000)),
+        n_workers=int(gene_stats_cfg.get("n_workers", 1)),
+    )
+    save_gene_stats(gene_stats_table(groups, gene_ids), config["output"]["base_dir"])
+    return groups
 
 def main():
     """
@@ -102,17 +322,31 @@ def main():
         default="/app/config.yaml",
         help="Path to the YAML configuration file"
     )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Only process samples not yet in the cohort state and upsert their metrics"
+    )
     args = parser.parse_args()
 
     try:
         print(f"Starting Pipeline with config: {args.config}")
-        run_pipeline(args.config) # On passe l'argument analysé
+        config = load_config(args.config)
+        validate_config_structure(config)
+        samples_path = (config.get("incremental", {}).get("samples_path") if args.append
+                        else config["input"]["samples"]["path"])
+        input_files = {"counts": config["input"]["counts"]["path"], "samples": samples_path, "config": args.config}
 
-        print("Exporting results to PostgreSQL...")
-        run_database() #
+        print("Exporting results to PostgreSQL in the background...")
+        with BackgroundExporter(append=args.append, input_files=input_files, # flushed and joined on exit
+                                on_duplicate=config.get("database", {}).get("on_duplicate", "skip")) as exporter:
+            if args.append:
+                run_append(args.config, exporter=exporter)
+            else:
+                run_pipeline(args.config, exporter=exporter) # On passe l'argument analysé
 
         print("Pipeline execution completed successfully.")
-    except (FileNotFoundError, ValueError) as e:
+    except (FileNotFoundError, ValueError, RuntimeError) as e:
         print(f"Error occurred: {e}")
 
 if __name__ == "__main__":
@@ -2,12 +2,19 @@
 
 import pandas as pd
 import matplotlib.pyplot as plt
+import matplotlib.cbook as cbook
 import seaborn as sns
 import numpy as np
 import os 
+import hashlib
+import warnings
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import squareform
 
 from rnaseq.io_setup import *
 
+_CLUSTER_CACHE = {} # correlation hash -> (order, linkage), see cluster_order
+
 def library_size(df):
     """
     Docstring for library_size
@@ -74,12 +81,21 @@ def log_transform(counts_df, base="log1p"):
         raise ValueError("Unsupported log base. Use 'log1p' 'log10' or 'log2'.")
 
 def plot_log_boxplot(counts_df: pd.DataFrame,output_dir: str) -> None:
-    os.makedirs(output_dir, exist_ok=True)
-
     log_df = log_transform(counts_df)
+    box_stats = cbook.boxplot_stats(log_df.values, labels=log_df.columns)
+    draw_log_boxplot(box_stats, output_dir)
+
+def draw_log_boxplot(box_stats: list, output_dir: str) -> None:
+    """
+    Draw the log-count boxplot from precomputed per-sample statistics.
+
+    :param box_stats: One matplotlib.cbook.boxplot_stats entry per sample.
+    :param output_dir: Directory to save the plot.
+    """
+    os.makedirs(output_dir, exist_ok=True)
 
     plt.figure(figsize=(8, 4))
-    plt.boxplot(log_df.values, labels=log_df.columns)
+    plt.gca().bxp(box_stats)
     plt.xticks(rotation=90)
     plt.ylabel("log(count + 1)")
     plt.title("Log-transformed count distribution")
@@ -88,9 +104,18 @@ def plot_log_boxplot(counts_df: pd.DataFrame,output_dir: str) -> None:
     plt.close()
 
 def plot_library_size(counts_df: pd.DataFrame,samples_df: pd.DataFrame,output_dir: str) -> None:
+    draw_library_size(library_size(counts_df), samples_df, output_dir)
+
+def draw_library_size(libsize: pd.Series, samples_df: pd.DataFrame, output_dir: str) -> None:
+    """
+    Draw the library size barplot from precomputed library sizes.
+
+    :param libsize: Series of library sizes indexed by sample_id.
+    :param samples_df: DataFrame containing sample annotations.
+    :param output_dir: Directory to save the plot.
+    """
     os.makedirs(output_dir, exist_ok=True)
 
-    libsize = library_size(counts_df)
     plot_df = pd.DataFrame({"sample_id": libsize.index,"library_size": libsize.values}).merge(samples_df[["sample_id", "condition"]],on="sample_id")
 
     plt.figure(figsize=(10, 6))
@@ -101,19 +126,149 @@ def plot_library_size(counts_df: pd.DataFrame,samples_df: pd.DataFrame,output_di
     plt.savefig(os.path.join(output_dir, "library_size.png"))
     plt.close()
 
-def plot_sample_correlation(counts_df: pd.DataFrame,output_dir: str) -> pd.DataFrame:
+def plot_sample_correlation(counts_df: pd.DataFrame,output_dir: str, base: str = "log1p") -> pd.DataFrame:
+    corr_df = log_transform(counts_df, base=base).corr()
+    draw_correlation_heatmap(corr_df, output_dir)
+    return corr_df
+
+def cluster_order(corr_df: pd.DataFrame, cache_dir: str = None, optimal_ordering: bool = True) -> tuple:
+    """
+    Hierarchical clustering order of the samples of a correlation matrix.
+
+    Average linkage on the condensed 1 - correlation distance, optionally
+    followed by optimal leaf ordering (whose cost grows about cubically with
+    the number of samples). The result is cached in memory and, when
+    cache_dir is given, in cache_dir/sample_order.npz, keyed by a hash of
+    the matrix so it is only recomputed when the correlations change.
+
+    :param corr_df: Square sample correlation matrix.
+    :param cache_dir: Optional directory for the on-disk cache.
+    :param optimal_ordering: Reorder the leaves to minimise distances between neighbours.
+    :return: (order, linkage) with order the sample positions in leaf order.
+    """
+    key = hashlib.sha256(corr_df.to_numpy(dtype=np.float64).tobytes())
+    key.update("\x1f".join(map(str, corr_df.index)).encode())
+    key.update(b"olo" if optimal_ordering else b"")
+    key = key.hexdigest()
+
+    if key in _CLUSTER_CACHE:
+        return _CLUSTER_CACHE[key]
+
+    cache_path = os.path.join(cache_dir, "sample_order.npz") if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            if str(cached["key"]) == key:
+                _CLUSTER_CACHE[key] = (cached["order"], cached["linkage"])
+                return _CLUSTER_CACHE[key]
+
+    dist = 1.0 - np.nan_to_num(corr_df.to_numpy(dtype=np.float64), nan=0.0)
+    condensed = np.clip(squareform(dist, checks=False), 0.0, None)
+    linkage = hierarchy.linkage(condensed, method="average")
+    if optimal_ordering:
+        linkage = hierarchy.optimal_leaf_ordering(linkage, condensed)
+    order = hierarchy.leaves_list(linkage)
+
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(cache_path, key=key, order=order, linkage=linkage)
+    _CLUSTER_CACHE[key] = (order, linkage)
+    return order, linkage
+
+def downsample_matrix(matrix: np.ndarray, max_size: int) -> np.ndarray:
+    """
+    Average square blocks of matrix so that no side exceeds max_size cells.
+
+    :param matrix: 2D array.
+    :param max_size: Maximum number of rows/columns of the result (output pixels).
+    :return: matrix itself when small enough, otherwise the block-averaged matrix.
+    """
+    factor = int(np.ceil(max(matrix.shape) / max_size))
+    if factor <= 1:
+        return matrix
+
+    n_rows = int(np.ceil(matrix.shape[0] / factor)) * factor
+    n_cols = int(np.ceil(matrix.shape[1] / factor)) * factor
+    padded = np.full((n_rows, n_cols), np.nan)
+    padded[:matrix.shape[0], :matrix.shape[1]] = matrix
+
+    blocks = padded.reshape(n_rows // factor, factor, n_cols // factor, factor)
+    with warnings.catch_warnings(): # all-NaN padding blocks
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmean(blocks, axis=(1, 3))
+
+def draw_correlation_heatmap(corr_df: pd.DataFrame, output_dir: str, cluster: bool = True,
+                             dendrogram: bool = True, max_labels: int = 50,
+                             max_optimal_ordering: int = 1000) -> None:
+    """
+    Draw the sample-sample correlation heatmap as a raster image.
+
+    The matrix is drawn with imshow, so the cost and file size do not grow
+    with the number of cells. Samples are ordered by hierarchical clustering
+    (see cluster_order) and, when the matrix is larger than the pixel size
+    of the heatmap axes, blocks of cells are averaged down to that resolution.
+
+    :param corr_df: Square sample correlation matrix.
+    :param output_dir: Directory to save the plot.
+    :param cluster: Reorder samples by hierarchical clustering.
+    :param dendrogram: Draw the clustering dendrogram above the heatmap.
+    :param max_labels: Sample labels are only drawn up to this many samples.
+    :param max_optimal_ordering: Optimal leaf ordering is skipped above this many samples.
+    """
     os.makedirs(output_dir, exist_ok=True)
 
-    corr_df = log_transform(counts_df).corr()
+    linkage = None
+    if cluster and len(corr_df) > 2:
+        order, linkage = cluster_order(corr_df, cache_dir=output_dir,
+                                       optimal_ordering=len(corr_df) <= max_optimal_ordering)
+        corr_df = corr_df.iloc[order, order]
+    show_dendrogram = dendrogram and linkage is not None
+
+    fig = plt.figure(figsize=(8, 9) if show_dendrogram else (8, 8))
+    if show_dendrogram:
+        grid = fig.add_gridspec(2, 2, height_ratios=[1, 8], width_ratios=[20, 1])
+        ax_dendro = fig.add_subplot(grid[0, 0])
+        ax_heat = fig.add_subplot(grid[1, 0])
+        ax_cbar = fig.add_subplot(grid[1, 1])
+        hierarchy.dendrogram(linkage, ax=ax_dendro, no_labels=True, color_threshold=0,
+                             above_threshold_color="black")
+        ax_dendro.set_axis_off()
+        ax_dendro.set_title("Sample-sample correlation")
+    else:
+        grid = fig.add_gridspec(1, 2, width_ratios=[20, 1])
+        ax_heat = fig.add_subplot(grid[0, 0])
+        ax_cbar = fig.add_subplot(grid[0, 1])
+        ax_heat.set_title("Sample-sample correlation")
+
+    n_samples = len(corr_df)
+    values = corr_df.to_numpy(dtype=np.float64)
+    norm = plt.Normalize(np.nanmin(values), np.nanmax(values))
+    cmap = plt.get_cmap("coolwarm")
+    fig.colorbar(plt.cm.ScalarMappable(norm=norm, cmap=cmap), cax=ax_cbar)
+
+    ax_heat.set_xlim(0, n_samples)
+    ax_heat.set_ylim(n_samples, 0)
+    if n_samples <= max_labels:
+        ticks = np.arange(n_samples) + 0.5
+        ax_heat.set_xticks(ticks)
+        ax_heat.set_xticklabels(corr_df.columns, rotation=90)
+        ax_heat.set_yticks(ticks)
+        ax_heat.set_yticklabels(corr_df.index)
+    else:
+        ax_heat.set_xticks([])
+        ax_heat.set_yticks([])
+        ax_heat.set_xlabel(f"{n_samples} samples")
 
-    plt.figure(figsize=(8, 8))
-    sns.heatmap(corr_df, cmap="coolwarm", square=True)
-    plt.title("Sample-sample correlation")
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, "sample_correlation.png"))
-    plt.close()
+    # the image is sized to the heatmap axes once the layout is final
+    fig.tight_layout()
+    extent = ax_heat.get_window_extent()
+    image = downsample_matrix(values, max(1, int(min(extent.width, extent.height))))
 
-    return corr_df
+    # extent keeps sample coordinates even when the image is downsampled
+    ax_heat.imshow(image, cmap=cmap, norm=norm, interpolation="nearest", aspect="auto",
+                   extent=(0, n_samples, n_samples, 0))
+
+    fig.savefig(os.path.join(output_dir, "sample_correlation.png"))
+    plt.close(fig)
 
 def build_qc_table(counts_df, samples_df) -> pd.DataFrame:
     """
@@ -159,7 +314,8 @@ def save_qc_table(qc_df: pd.DataFrame,output_dir: str,filename: str = "qc_table.
     
     qc_df.to_csv(out_path, index=True) # save with index (sample_id)
 
-def qc_all(counts_df: pd.DataFrame, samples_df: pd.DataFrame, output_dir: str) -> pd.DataFrame:
+def qc_all(counts_df: pd.DataFrame, samples_df: pd.DataFrame, output_dir: str, exporter=None,
+           base: str = "log1p") -> tuple:
     """
     Perform all QC analyses and generate outputs.
 
@@ -171,16 +327,28 @@ def qc_all(counts_df: pd.DataFrame, samples_df: pd.DataFrame, output_dir: str) -
         DataFrame containing sample annotations.
     output_dir : str
         Directory to save QC output files.  
+    exporter : BackgroundExporter, optional
+        When given, the QC table is handed to it before the plots are rendered.
+    base : str
+        Log transform of the correlation matrix, see log_transform.
+
+    Returns
+    -------
+    tuple
+        (qc_df, corr_df): the QC table and the sample-sample correlation
+        of the log counts, as returned by out_of_core.qc_all_out_of_core.
     """
 
     qc_dir = os.path.join(output_dir, "qc")
 
-    plot_library_size(counts_df, samples_df, qc_dir)
-    plot_log_boxplot(counts_df, qc_dir)
-    plot_sample_correlation(counts_df, qc_dir)
-
     qc_df = build_qc_table(counts_df, samples_df)
     qc_df.index.name = "sample_id"
+    if exporter is not None:
+        exporter.submit_qc_table(qc_df)
     save_qc_table(qc_df, output_dir)
 
-    return qc_df
+    plot_library_size(counts_df, samples_df, qc_dir)
+    plot_log_boxplot(counts_df, qc_dir)
+    corr_df = plot_sample_correlation(counts_df, qc_dir, base=base)
+
+    return qc_df, corr_df
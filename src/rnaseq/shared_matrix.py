@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""Zero-copy count matrix handoff to worker processes.
+
+The parent fills a SharedCountsMatrix once from the loaded counts and
+passes its small, picklable
+SharedMatrixHandle to the workers instead of the matrix itself. Workers
+attach to the same shared memory block and get a read-only NumPy view
+with the gene/sample labels, so nothing is copied or serialized.
+
+Only the owner unlinks the block: when its context exits (also on a
+worker crash, e.g. BrokenProcessPool), when it is garbage collected, or
+at interpreter exit. If the owner itself is killed, the multiprocessing
+resource tracker removes the block. Workers must therefore be child
+processes of the owner (multiprocessing / concurrent.futures pools), so
+they share its resource tracker.
+"""
+
+import weakref
+from contextlib import contextmanager
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass(frozen=True)
+class SharedMatrixHandle:
+    """
+    Picklable description of a shared matrix: block name, layout and labels.
+    """
+    name: str
+    shape: tuple
+    dtype: str
+    gene_ids: tuple
+    sample_ids: tuple
+
+
+def _release(shm: shared_memory.SharedMemory, unlink: bool) -> None:
+    # unlink first: the name must go even if views are still alive in this process
+    if unlink:
+        try:
+            shm.unlink()
+        except FileNotFoundError: # already removed
+            pass
+    try:
+        shm.close()
+    except BufferError: # views still referenced; the mapping is freed with them
+        pass
+
+
+class SharedCountsMatrix:
+    """
+    Owner of a (n_genes, n_samples) matrix stored in shared memory.
+
+    Parameters
+    ----------
+    shape : tuple
+        (n_genes, n_samples).
+    gene_ids, sample_ids : array-like
+        Row and column labels.
+    dtype : numpy dtype
+        Element type, int64 for raw counts.
+    """
+
+    def __init__(self, shape, gene_ids, sample_ids, dtype=np.int64):
+        dtype = np.dtype(dtype)
+        if len(gene_ids) != shape[0] or len(sample_ids) != shape[1]:
+            raise ValueError("gene_ids / sample_ids do not match the matrix shape")
+
+        size = max(1, int(np.prod(shape)) * dtype.itemsize) # zero-size blocks are not allowed
+        self._shm = shared_memory.SharedMemory(create=True, size=size)
+        self._finalizer = weakref.finalize(self, _release, self._shm, True)
+
+        self.values = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf)
+        self.handle = SharedMatrixHandle(
+            name=self._shm.name,
+            shape=tuple(shape),
+            dtype=dtype.str,
+            gene_ids=tuple(g.item() if hasattr(g, "item") else g for g in gene_ids),
+            sample_ids=tuple(sample_ids),
+        )
+
+    @classmethod
+    def from_dataframe(cls, counts_df: pd.DataFrame) -> "SharedCountsMatrix":
+        """Copy a canonical counts DataFrame into shared memory."""
+        matrix = cls(counts_df.shape, counts_df.index, counts_df.columns, dtype=np.int64)
+        matrix.values[:] = counts_df.to_numpy(dtype=np.int64)
+        return matrix
+
+    def close(self) -> None:
+        """Release and unlink the shared block; safe to call more than once."""
+        self.values = None
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+@contextmanager
+def attach_shared_matrix(handle: SharedMatrixHandle):
+    """
+    Attach to a shared matrix from a worker process.
+
+    Yields a read-only np.ndarray view; the block is detached (never
+    unlinked) when the context exits.
+    """
+    shm = shared_memory.SharedMemory(name=handle.name)
+    values = np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=shm.buf)
+    values.flags.writeable = False
+    try:
+        yield values
+    finally:
+        del values
+        _release(shm, unlink=False)
+
+
+def shared_matrix_frame(values: np.ndarray, handle: SharedMatrixHandle) -> pd.DataFrame:
+    """
+    Label a view of a shared matrix as a canonical counts DataFrame (no copy).
+    """
+    return pd.DataFrame(values, index=pd.Index(handle.gene_ids, name="gene_id"),
+                        columns=list(handle.sample_ids), copy=False)
@@ -0,0 +1,216 @@
+import copy
+import os
+import sys
+
+import matplotlib
+import pandas as pd
+import pytest
+import yaml
+
+matplotlib.use("Agg")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(ROOT, "data")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from rnaseq import db_export  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def gse60450(tmp_path_factory):
+    """
+    GSE60450 inputs in the layout written by r/clean_data.R (leading row index column).
+
+    Returns a function n_samples -> (counts_path, series_path) restricted to the
+    first n_samples samples (both files keep the same sample order).
+    """
+    data_dir = tmp_path_factory.mktemp("gse60450")
+    counts = pd.read_csv(os.path.join(DATA_DIR, "GSE60450_Lactation-GenewiseCounts.txt"), sep="\t")
+    with open(os.path.join(DATA_DIR, "GSE60450_series_matrix.txt")) as fh:
+        series = fh.read().splitlines()
+
+    def inputs(n_samples=12):
+        counts_path = data_dir / f"counts_{n_samples}.txt"
+        series_path = data_dir / f"series_{n_samples}.txt"
+        if not counts_path.exists():
+            counts.iloc[:, :2 + n_samples].to_csv(counts_path, sep="\t")
+            lines = []
+            for line in series:
+                if line.startswith("!Series_sample_id"):
+                    accessions = line.split("\t", 1)[1].strip('" ').split()[:n_samples]
+                    line = '!Series_sample_id\t"' + " ".join(accessions) + '"'
+                lines.append(line)
+            series_path.write_text("\n".join(lines) + "\n")
+        return str(counts_path), str(series_path)
+
+    return inputs
+
+
+@pytest.fixture
+def make_config(tmp_path):
+    """
+    Write a copy of config.yaml pointing at the given inputs and at an output
+    directory under tmp_path; returns (config_path, config).
+    """
+    with open(os.path.join(ROOT, "config.yaml")) as fh:
+        base = yaml.safe_load(fh)
+
+    def write(name, counts_path, series_path, mode="in_memory", block_size=5000, n_workers=1):
+        config = copy.deepcopy(base)
+        out_dir = tmp_path / name
+        config["input"]["counts"]["path"] = counts_path
+        config["input"]["samples"]["path"] = series_path
+        config["qc"]["execution"].update(mode=mode, block_size=block_size, workdir=str(out_dir / "out_of_core"))
+        config["qc"]["gene_stats"]["n_workers"] = n_workers
+        config["output"]["base_dir"] = str(out_dir)
+        config["incremental"]["state_dir"] = str(out_dir / "cohort_state")
+        config["incremental"]["samples_path"] = os.path.join(DATA_DIR, "samples.csv")
+        config_path = tmp_path / f"{name}.yaml"
+        with open(config_path, "w") as fh:
+            yaml.safe_dump(config, fh)
+        return str(config_path), config
+
+    return write
+
+
+class FakeDatabase:
+    """
+    In-memory stand-in for the runs / qc_metrics tables used by BackgroundExporter.
+
+    Writes go to a working copy that becomes visible on commit and is
+    discarded on rollback or when the connection closes uncommitted.
+    Every bookkeeping call is recorded in log.
+    """
+
+    def __init__(self):
+        self.committed = {"runs": {}, "qc_metrics": {}, "samples": set()}
+        self.state = copy.deepcopy(self.committed)
+        self.log = []
+        self.insert_errors = [] # raised by the next insert_dataframe calls, None lets a call through
+        self.connections = 0
+
+    def add_run(self, dataset_id="ds", status="completed", fingerprint=None, samples=()):
+        run_id = max(self.committed["runs"], default=0) + 1
+        self.committed["runs"][run_id] = {"dataset_id": dataset_id, "status": status, "fingerprint": fingerprint}
+        for sample_id in samples:
+            self.committed["qc_metrics"][(run_id, sample_id)] = {"library_size": 1}
+        self.state = copy.deepcopy(self.committed)
+        return run_id
+
+    def metrics(self, run_id):
+        return sorted(s for r, s in self.committed["qc_metrics"] if r == run_id)
+
+    def status(self, run_id):
+        return self.committed["runs"][run_id]["status"]
+
+    def commit(self):
+        self.committed = copy.deepcopy(self.state)
+
+    def rollback(self):
+        self.state = copy.deepcopy(self.committed)
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=()):
+        if query.startswith("DELETE FROM qc_metrics"):
+            run_id = params[0]
+            metrics = self.db.state["qc_metrics"]
+            for key in [k for k in metrics if k[0] == run_id]:
+                del metrics[key]
+            self.db.log.append(("clear", run_id))
+        else:
+            raise NotImplementedError(query)
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+        self.closed = False
+        db.connections += 1
+
+    def cursor(self):
+        return FakeCursor(self.db)
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        if not self.closed:
+            self.db.rollback()
+        self.closed = True
+
+
+def _register_run(cur, run_name, version, dataset_id, fingerprint=None, status="completed"):
+    runs = cur.db.state["runs"]
+    run_id = max(runs, default=0) + 1
+    runs[run_id] = {"dataset_id": dataset_id, "status": status,
+                    "fingerprint": (fingerprint or {}).get("input_fingerprint")}
+    cur.db.log.append(("register", run_id, status))
+    return run_id
+
+
+def _find_run_by_fingerprint(cur, input_fingerprint):
+    for run_id, run in cur.db.state["runs"].items():
+        if run["fingerprint"] == input_fingerprint:
+            return run_id, run["status"]
+    return None
+
+
+def _set_run_status(cur, run_id, status, fingerprint=None, version=None):
+    run = cur.db.state["runs"][run_id]
+    run["status"] = status
+    if fingerprint:
+        run["fingerprint"] = fingerprint["input_fingerprint"]
+    cur.db.log.append(("set_status", run_id, status))
+
+
+def _latest_run_id(cur, dataset_id):
+    completed = [r for r, run in cur.db.state["runs"].items()
+                 if run["dataset_id"] == dataset_id and run["status"] == "completed"]
+    return max(completed, default=None)
+
+
+def _insert_dataframe(cur, df, table_name, run_id, upsert=False):
+    db = cur.db
+    error = db.insert_errors.pop(0) if db.insert_errors else None
+    if error is not None:
+        raise error
+    if table_name == "qc_metrics":
+        for sample_id in df["sample_id"]:
+            key = (run_id, sample_id)
+            if key in db.state["qc_metrics"] and not upsert:
+                raise AssertionError(f"duplicate key {key}")
+            db.state["qc_metrics"][key] = {"library_size": 1}
+    else:
+        db.state["samples"].update(df["sample_id"])
+    db.log.append(("insert", table_name, run_id, len(df)))
+    return len(df)
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """A FakeDatabase wired into rnaseq.db_export; use fake_db.connect as the exporter's connect."""
+    db = FakeDatabase()
+    db.connect = lambda: FakeConnection(db)
+    monkeypatch.setattr(db_export, "create_tables", lambda conn: None)
+    monkeypatch.setattr(db_export, "register_run", _register_run)
+    monkeypatch.setattr(db_export, "find_run_by_fingerprint", _find_run_by_fingerprint)
+    monkeypatch.setattr(db_export, "set_run_status", _set_run_status)
+    monkeypatch.setattr(db_export, "latest_run_id", _latest_run_id)
+    monkeypatch.setattr(db_export, "insert_dataframe", _insert_dataframe)
+    monkeypatch.setattr(db_export, "refresh_run_summary", lambda cur, run_id: cur.db.log.append(("summary", run_id)))
+    monkeypatch.setattr(db_export, "refresh_condition_summary",
+                        lambda cur, run_id: cur.db.log.append(("condition_summary", run_id)))
+    return db
@@ -0,0 +1,128 @@
+import pandas as pd
+import psycopg2
+import pytest
+
+from rnaseq.db_export import BackgroundExporter, input_fingerprint
+
+
+def qc_table(sample_ids):
+    return pd.DataFrame({
+        "sample_id": list(sample_ids),
+        "condition": "virgin",
+        "library_size": 1000,
+        "zero_fraction": 10.0,
+        "expressed_genes": 500,
+    })
+
+
+def test_failed_append_keeps_base_run_completed(fake_db):
+    base = fake_db.add_run(samples=["DG", "DH"])
+    fake_db.insert_errors.append(psycopg2.DataError("bad value"))
+
+    exporter = BackgroundExporter(dataset_id="ds", version="v", append=True, connect=fake_db.connect)
+    with pytest.raises(RuntimeError):
+        with exporter:
+            exporter.submit_qc_table(qc_table(["LA", "LB"]))
+
+    assert exporter.run_id == base
+    assert ("set_status", base, "failed") not in fake_db.log
+    assert fake_db.status(base) == "completed"
+    assert fake_db.metrics(base) == ["DG", "DH"]
+
+
+def test_failed_append_retry_writes_into_base_run(fake_db):
+    base = fake_db.add_run(samples=["DG", "DH"])
+    fake_db.insert_errors.append(psycopg2.DataError("bad value"))
+    with pytest.raises(RuntimeError):
+        with BackgroundExporter(dataset_id="ds", version="v", append=True, connect=fake_db.connect) as exporter:
+            exporter.submit_qc_table(qc_table(["LA", "LB"]))
+
+    with BackgroundExporter(dataset_id="ds", version="v", append=True, connect=fake_db.connect) as exporter:
+        exporter.submit_qc_table(qc_table(["LA", "LB"]))
+
+    assert exporter.run_id == base
+    assert list(fake_db.committed["runs"]) == [base]
+    assert fake_db.metrics(base) == ["DG", "DH", "LA", "LB"]
+
+
+@pytest.fixture
+def input_files(tmp_path):
+    paths = {}
+    for name in ("counts", "samples", "config"):
+        paths[name] = tmp_path / f"{name}.txt"
+        paths[name].write_text(name)
+    return {name: str(path) for name, path in paths.items()}
+
+
+def exported_run(fake_db, input_files, status="completed"):
+    fingerprint = input_fingerprint(input_files["counts"], input_files["samples"], input_files["config"], "v")
+    return fake_db.add_run(status=status, fingerprint=fingerprint["input_fingerprint"], samples=["DG", "DH"])
+
+
+def test_identical_inputs_are_skipped(fake_db, input_files):
+    run_id = exported_run(fake_db, input_files)
+
+    with BackgroundExporter(dataset_id="ds", version="v", input_files=input_files, connect=fake_db.connect) as exporter:
+        exporter.submit_qc_table(qc_table(["LA", "LB"]))
+
+    assert exporter.skipped
+    assert not [entry for entry in fake_db.log if entry[0] == "insert"]
+    assert list(fake_db.committed["runs"]) == [run_id]
+    assert fake_db.metrics(run_id) == ["DG", "DH"]
+
+
+def test_identical_inputs_replace_the_run(fake_db, input_files):
+    run_id = exported_run(fake_db, input_files)
+
+    with BackgroundExporter(dataset_id="ds", version="v", input_files=input_files, on_duplicate="replace",
+                            connect=fake_db.connect) as exporter:
+        exporter.submit_qc_table(qc_table(["LA", "LB"]))
+
+    assert exporter.run_id == run_id
+    assert list(fake_db.committed["runs"]) == [run_id]
+    assert fake_db.metrics(run_id) == ["LA", "LB"]
+    assert fake_db.status(run_id) == "completed"
+    assert ("summary", run_id) in fake_db.log and ("condition_summary", run_id) in fake_db.log
+
+
+def test_interrupted_export_is_reused(fake_db, input_files):
+    run_id = exported_run(fake_db, input_files, status="running")
+
+    with BackgroundExporter(dataset_id="ds", version="v", input_files=input_files, connect=fake_db.connect) as exporter:
+        exporter.submit_qc_table(qc_table(["LA", "LB"]))
+
+    assert exporter.run_id == run_id
+    assert fake_db.metrics(run_id) == ["LA", "LB"]
+    assert fake_db.status(run_id) == "completed"
+
+
+def test_failed_export_rolls_back_and_marks_run_failed(fake_db, input_files):
+    fake_db.insert_errors.extend([None, psycopg2.DataError("bad value")]) # samples pass, qc_metrics fails
+
+    exporter = BackgroundExporter(dataset_id="ds", version="v", input_files=input_files, connect=fake_db.connect)
+    with pytest.raises(RuntimeError, match="bad value"):
+        with exporter:
+            exporter.submit_qc_table(qc_table(["LA", "LB"]))
+
+    assert fake_db.status(exporter.run_id) == "failed"
+    assert fake_db.metrics(exporter.run_id) == []
+    assert fake_db.committed["samples"] == set()
+    assert not [entry for entry in fake_db.log if entry[0] == "summary"]
+
+
+def test_transient_error_reconnects_and_replays(fake_db, input_files):
+    fake_db.insert_errors.extend([None, psycopg2.OperationalError("connection lost")])
+
+    with BackgroundExporter(dataset_id="ds", version="v", input_files=input_files, backoff=0,
+                            connect=fake_db.connect) as exporter:
+        exporter.submit_qc_table(qc_table(["LA", "LB"]))
+
+    assert fake_db.connections == 2
+    assert [entry for entry in fake_db.log if entry[0] == "insert"] == [
+        ("insert", "samples", exporter.run_id, 2), # first attempt, rolled back with the lost connection
+        ("insert", "samples", exporter.run_id, 2), # replayed from the journal
+        ("insert", "qc_metrics", exporter.run_id, 2),
+    ]
+    assert fake_db.metrics(exporter.run_id) == ["LA", "LB"]
+    assert fake_db.committed["samples"] == {"LA", "LB"}
+    assert fake_db.status(exporter.run_id) == "completed"
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from rnaseq.gene_stats import FIELDS
+from rnaseq.incremental import load_gene_stats, load_sample_correlation, open_log_counts, read_cohort_meta
+from rnaseq.pipeline import run_append, run_pipeline
+
+
+@pytest.fixture
+def full_run(gse60450, make_config):
+    """State directory and outputs of a full in-memory run on the 12 samples."""
+    config_path, config = make_config("full", *gse60450(12))
+    run_pipeline(config_path)
+    return config
+
+
+@pytest.mark.parametrize("mode", ["in_memory", "out_of_core"])
+def test_append_matches_full_run(gse60450, make_config, full_run, mode):
+    counts_8, series_8 = gse60450(8)
+    counts_12, _ = gse60450(12)
+    base_path, config = make_config("cohort", counts_8, series_8, mode=mode, block_size=4000)
+    run_pipeline(base_path)
+    base_meta = read_cohort_meta(config["incremental"]["state_dir"])
+    assert base_meta["sample_ids"] == ["DG", "DH", "DI", "DJ", "DK", "DL", "LA", "LB"]
+
+    # same output and state directories, counts file with the 4 extra samples
+    append_path, config = make_config("cohort", counts_12, series_8, mode=mode, block_size=4000)
+    run_append(append_path)
+
+    state, full_state = config["incremental"]["state_dir"], full_run["incremental"]["state_dir"]
+    meta, full_meta = read_cohort_meta(state), read_cohort_meta(full_state)
+    assert meta["sample_ids"] == full_meta["sample_ids"]
+    assert meta["generation"] == 1
+
+    pd.testing.assert_frame_equal(load_sample_correlation(state), load_sample_correlation(full_state),
+                                  check_exact=False, atol=1e-12)
+    np.testing.assert_allclose(open_log_counts(state, meta), open_log_counts(full_state, full_meta))
+
+    groups, full_groups = load_gene_stats(state), load_gene_stats(full_state)
+    assert groups.keys() == full_groups.keys()
+    for group in full_groups:
+        assert groups[group].n == full_groups[group].n
+        for field in FIELDS:
+            np.testing.assert_allclose(getattr(groups[group], field), getattr(full_groups[group], field))
+
+    out_dir, full_dir = config["output"]["base_dir"], full_run["output"]["base_dir"]
+    pd.testing.assert_frame_equal(pd.read_csv(f"{out_dir}/qc_table.csv", index_col="sample_id"),
+                                  pd.read_csv(f"{full_dir}/qc_table.csv", index_col="sample_id"))
+    pd.testing.assert_frame_equal(pd.read_parquet(f"{out_dir}/gene_stats.parquet"),
+                                  pd.read_parquet(f"{full_dir}/gene_stats.parquet"),
+                                  check_exact=False, rtol=1e-9)
+
+
+def test_append_without_new_samples_keeps_state(gse60450, make_config, full_run):
+    config_path, _ = make_config("full", *gse60450(12))
+    run_append(config_path)
+
+    assert read_cohort_meta(full_run["incremental"]["state_dir"])["generation"] == 0
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+from rnaseq.gene_stats import FIELDS, compute_gene_stats
+from rnaseq.incremental import load_gene_stats, load_sample_correlation, open_log_counts, read_cohort_meta
+from rnaseq.pipeline import run_pipeline
+from rnaseq.shared_matrix import SharedCountsMatrix
+
+
+def assert_groups_close(groups_a, groups_b):
+    assert groups_a.keys() == groups_b.keys()
+    for group in groups_a:
+        assert groups_a[group].n == groups_b[group].n
+        for field in FIELDS:
+            np.testing.assert_allclose(getattr(groups_a[group], field), getattr(groups_b[group], field))
+
+
+def test_out_of_core_matches_in_memory(gse60450, make_config):
+    outputs = {}
+    for mode in ("in_memory", "out_of_core"):
+        config_path, config = make_config(mode, *gse60450(12), mode=mode, block_size=4000)
+        run_pipeline(config_path)
+        outputs[mode] = (config["output"]["base_dir"], config["incremental"]["state_dir"])
+    (out_a, state_a), (out_b, state_b) = outputs["in_memory"], outputs["out_of_core"]
+
+    pd.testing.assert_frame_equal(pd.read_csv(f"{out_a}/qc_table.csv", index_col="sample_id"),
+                                  pd.read_csv(f"{out_b}/qc_table.csv", index_col="sample_id"))
+    pd.testing.assert_frame_equal(pd.read_parquet(f"{out_a}/gene_stats.parquet"),
+                                  pd.read_parquet(f"{out_b}/gene_stats.parquet"),
+                                  check_exact=False, rtol=1e-9)
+
+    pd.testing.assert_frame_equal(load_sample_correlation(state_a), load_sample_correlation(state_b),
+                                  check_exact=False, atol=1e-12)
+    np.testing.assert_allclose(open_log_counts(state_a, read_cohort_meta(state_a)),
+                               open_log_counts(state_b, read_cohort_meta(state_b)))
+    groups = load_gene_stats(state_a)
+    assert groups.keys() == {"all", "virgin", "lactation"}
+    assert_groups_close(groups, load_gene_stats(state_b))
+
+
+def test_shared_matrix_workers_match_single_process():
+    rng = np.random.default_rng(0)
+    counts_df = pd.DataFrame(rng.poisson(20, (3000, 10)),
+                             index=pd.Index(range(3000), name="gene_id"),
+                             columns=[f"S{i}" for i in range(10)])
+    conditions = ["virgin", "lactation"] * 5
+
+    single = compute_gene_stats(counts_df.to_numpy(), conditions, block_size=700)
+    with SharedCountsMatrix.from_dataframe(counts_df) as shared:
+        pooled = compute_gene_stats(shared.handle, conditions, block_size=700, n_workers=3)
+    assert_groups_close(single, pooled)